@@ -0,0 +1,103 @@
+#!/usr/bin/env python2
+
+# Simulates a federation running RotatingConsensus over consensus_sim's
+# in-memory network, and reports completed rounds per hour, round latency
+# (from the start of a round until its master's round_done) and the fraction
+# of rounds missed, so changes to the interval or the phase logic can be
+# judged without deploying them.
+#
+# Usage: bench_consensus.py [options]
+#   eg --nodes 7 --offline 1 --skew 2 to see what one dead functionary and
+#   a few seconds of clock skew cost, and --liveness-slots 3 to see how much
+#   of that skipping offline masters (and --clock-sync, correcting for skew)
+#   wins back.
+#
+# Needs the same python-bitcoinrpc and zmq imports as rotating_consensus itself.
+
+import sys, json, argparse
+from rotating_consensus import RotatingConsensus
+from round_trace import RoundTracer, percentiles
+from consensus_sim import SimNetwork, Simulator, Link
+from bench_withdrawwatch import Quiet
+
+class BenchNode(RotatingConsensus):
+	def gen_master_msg(self):
+		return "proposal %d" % self.round_id
+
+	def recv_master_msg(self, msg):
+		return "signature"
+
+	def round_done(self, peer_messages):
+		return
+
+
+def run(args):
+	network = SimNetwork(seed=args.seed)
+	network.default_link = Link(args.latency, args.jitter, args.loss)
+	hosts = ["node%d" % i for i in range(args.nodes)]
+	offline = set(hosts[len(hosts) - args.offline:])
+
+	simulator = Simulator(network)
+	online_nodes = []
+	for host in hosts:
+		skew = network.rng.uniform(-args.skew, args.skew)
+		transport = network.transport(host, [peer for peer in hosts if peer != host], skew)
+		transport.offline = host in offline
+		node = BenchNode([], host, None, args.interval, None, start_thread=False, quorum=args.quorum, transport=transport, liveness_slots=args.liveness_slots, clock_sync=args.clock_sync)
+		# Keep every round, not just the most recent ones
+		node.tracer = RoundTracer(keep=None, clock=node.time)
+		simulator.add(node)
+		if host not in offline:
+			online_nodes.append(node)
+
+	start = network.now
+	with Quiet():
+		simulator.run(start + args.hours * 3600)
+
+	# round id -> {host: trace}, as seen by the nodes which are up
+	rounds = {}
+	outcomes = {}
+	for node in online_nodes:
+		for trace in node.tracer.rounds:
+			rounds.setdefault(trace.round_id, {})[node.transport.host] = trace
+			outcomes[trace.outcome] = outcomes.get(trace.outcome, 0) + 1
+
+	completed = 0
+	latencies = []
+	for round_id in rounds:
+		traces = rounds[round_id].values()
+		master = [trace for trace in traces if trace.is_master]
+		if len([trace for trace in traces if not trace.outcome.startswith("done")]) != 0 or len(master) == 0:
+			continue
+		completed += 1
+		latencies.append([offset for (offset, name) in master[0].events if name == "end"][0])
+
+	results = {"workload": vars(args)}
+	results["rounds"] = len(rounds)
+	results["rounds_completed"] = completed
+	results["rounds_per_hour"] = completed / float(args.hours)
+	results["missed_round_rate"] = 1 - completed / float(max(len(rounds), 1))
+	results["round_latency_seconds"] = percentiles(latencies)
+	results["node_outcomes"] = outcomes
+	results["messages_sent"] = network.sent
+	results["messages_dropped"] = network.dropped
+	results["clock_error_seconds"] = max([node.time() for node in online_nodes]) - min([node.time() for node in online_nodes])
+	return results
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Simulate a federation running rotating consensus rounds")
+	parser.add_argument("--nodes", type=int, default=5)
+	parser.add_argument("--offline", type=int, default=0, help="nodes which never send anything")
+	parser.add_argument("--interval", type=int, default=60, help="seconds per round")
+	parser.add_argument("--hours", type=float, default=24, help="simulated hours to run for")
+	parser.add_argument("--latency", type=float, default=0.1, help="seconds for a message to cross any link")
+	parser.add_argument("--jitter", type=float, default=0.05, help="up to this many extra seconds per message")
+	parser.add_argument("--loss", type=float, default=0.0, help="fraction of messages lost on every link")
+	parser.add_argument("--skew", type=float, default=0.0, help="each node's clock is off by up to this many seconds")
+	parser.add_argument("--quorum", type=int, default=None)
+	parser.add_argument("--liveness-slots", type=int, default=None, help="skip masters not heard from for this many rounds")
+	parser.add_argument("--clock-sync", action="store_true", help="time rounds by the median of the nodes' estimated clocks")
+	parser.add_argument("--seed", type=int, default=1)
+	args = parser.parse_args()
+
+	print(json.dumps(run(args), indent=1, sort_keys=True))
@@ -0,0 +1,85 @@
+#!/usr/bin/env python2
+
+# Memory/speed comparison of withdrawwatch's old dict-of-dicts UTXO layout
+# against the withdraw_records types.
+# Usage: bench_withdraw_records.py [utxo_count] [waiting_queue_length]
+
+import sys, os, decimal, resource
+from collections import deque
+from time import time
+from withdraw_records import Utxo, txid_to_bin
+
+redeem_script = "55210269992fb441ae56968e5b77d46a3e53b69f136444ae65a94041fc937bdb28d93321021df31471281d4478df85bfce08a10aab82601dca949a79950f8ddf7002bd915a2102174c82021492c2c6dfcbfa4187d10d38bed06afb7fdcd72c880179fddd641ea121033f96e43d72c33327b6a4631ccaa6ea07f0b106c88b9dc71c9000bb6044d5e88a210313d8748790f2a86fb524579b46ce3c68fedd58d2a738716249a9f7d5458a15c221030b632eeb079eb83648886122a04c7bf6d98ab5dfb94cf353ee3e9382a4c2fab02102fb54a7fcaa73c307cfd70f3fa66a2e4247a71858ca731396343ad30c7c4009ce57ae"
+script_pubkey = "a914" + "6b" * 20 + "87"
+private_key = "cVGPjmWpeCsZyhVHWHhMaRrzCt6nBDA7E1UdU9Y6RNcTqDRS1P3c"
+
+def fake_txid(i):
+	return "%064x" % (i * 2654435761)
+
+def build_dicts(count):
+	utxos = {}
+	for i in range(count):
+		# Fresh copies of each string, as they come out of JSON-RPC
+		txid = fake_txid(i)
+		utxos[(txid, i % 4)] = {"redeem_info": {"txid": txid, "vout": i % 4, "scriptPubKey": u"%s" % script_pubkey, "redeemScript": u"%s" % redeem_script}, "privateKey": u"%s" % private_key, "value": decimal.Decimal("0.%08d" % (i % 100000000)), "spent_by": set(), "donated_map": {}}
+	return utxos
+
+def build_records(count):
+	utxos = {}
+	for i in range(count):
+		txid = txid_to_bin(fake_txid(i))
+		utxos[(txid, i % 4)] = Utxo(txid, i % 4, u"%s" % script_pubkey, u"%s" % redeem_script, u"%s" % private_key, i % 100000000)
+	return utxos
+
+def sum_dicts(utxos):
+	total = decimal.Decimal(0)
+	for i in range(len(utxos)):
+		total = total + utxos[(fake_txid(i), i % 4)]["value"]
+	return total
+
+def sum_records(utxos):
+	total = 0
+	for i in range(len(utxos)):
+		total = total + utxos[(txid_to_bin(fake_txid(i)), i % 4)].value
+	return total
+
+def measure(name, build, walk, count):
+	# Run in a child so each layout's peak RSS is measured on its own
+	pid = os.fork()
+	if pid != 0:
+		os.waitpid(pid, 0)
+		return
+	rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	start = time()
+	utxos = build(count)
+	built = time()
+	walk(utxos)
+	walked = time()
+	rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	print("%-8s build %7.2fs  lookup+sum %7.2fs  memory %8.1f MiB (%d bytes/utxo)" % (name, built - start, walked - built, (rss_after - rss_before) / 1024.0, (rss_after - rss_before) * 1024 / count))
+	sys.stdout.flush()
+	os._exit(0)
+
+def bench_waiting_queue(length):
+	queue = list(range(length))
+	start = time()
+	while len(queue) != 0:
+		queue.pop(0)
+	list_time = time() - start
+
+	queue = deque(range(length))
+	start = time()
+	while len(queue) != 0:
+		queue.popleft()
+	deque_time = time() - start
+
+	print("outputs_waiting drain of %d: list.pop(0) %.3fs, deque.popleft() %.3fs" % (length, list_time, deque_time))
+
+if __name__ == "__main__":
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+	waiting = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+
+	print("Tracking %d UTXOs:" % count)
+	measure("dicts", build_dicts, sum_dicts, count)
+	measure("records", build_records, sum_records, count)
+	bench_waiting_queue(waiting)
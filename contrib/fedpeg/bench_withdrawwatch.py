@@ -0,0 +1,546 @@
+#!/usr/bin/env python2
+
+# Throughput benchmark for withdrawwatch against synthetic sidechain and bitcoin
+# histories, served by in-process stand-ins for sidechaind, bitcoind, bitcoin-tx
+# and contracthashtool. Runs the chain scans and the WatchPeerController
+# callbacks (self-funded, or with --wallet-funded through a stand-in for the
+# bitcoind wallet's fundrawtransaction), mining each round's withdraw
+# transactions back into the bitcoin chain, and reports blocks per second,
+# per-round latency, any rounds which failed and peak memory.
+#
+# Usage: bench_withdrawwatch.py [options]
+#   --save results.json writes the results, --baseline results.json compares
+#   against an earlier run and exits non-zero on a regression (or if not every
+#   withdraw completed), for use as a performance gate.
+#
+# Needs the same python-bitcoinrpc and zmq imports as withdrawwatch itself.
+
+import sys, os, json, random, hashlib, struct, shlex, argparse, resource, tempfile, shutil, decimal
+from time import time
+from constants import FedpegConstants
+from bitcoin_raw import read_varint, double_sha256, parse_tx, p2sh_script_for_address
+
+COIN = 100000000
+
+def ser_varint(n):
+	if n < 0xfd:
+		return chr(n)
+	if n <= 0xffff:
+		return "\xfd" + struct.pack("<H", n)
+	return "\xfe" + struct.pack("<I", n)
+
+def ser_tx(inputs, outputs):
+	# inputs are (txid_hex, vout, scriptSig), outputs are (satoshis, scriptPubKey)
+	data = struct.pack("<i", 1) + ser_varint(len(inputs))
+	for (txid, vout, script_sig) in inputs:
+		data += txid.decode("hex")[::-1] + struct.pack("<I", vout) + ser_varint(len(script_sig)) + script_sig + "\xff\xff\xff\xff"
+	data += ser_varint(len(outputs))
+	for (value, script) in outputs:
+		data += struct.pack("<q", value) + ser_varint(len(script)) + script
+	return data + "\x00\x00\x00\x00"
+
+def deser_tx(data):
+	# The inverse of ser_tx (the stand-ins never produce witness data)
+	(input_count, pos) = read_varint(data, 4)
+	inputs = []
+	for i in range(input_count):
+		txid = data[pos:pos + 32][::-1].encode("hex")
+		vout = struct.unpack_from("<I", data, pos + 32)[0]
+		(script_len, pos) = read_varint(data, pos + 36)
+		inputs.append((txid, vout, data[pos:pos + script_len]))
+		pos += script_len + 4
+	(output_count, pos) = read_varint(data, pos)
+	outputs = []
+	for i in range(output_count):
+		value = struct.unpack_from("<q", data, pos)[0]
+		(script_len, pos) = read_varint(data, pos + 8)
+		outputs.append((value, data[pos:pos + script_len]))
+		pos += script_len
+	return (inputs, outputs)
+
+def txid_of(data):
+	return double_sha256(data)[::-1].encode("hex")
+
+def fake_p2sh(script_hex):
+	# The stand-ins never check hash160, so any 20 bytes will do
+	return "\xa9\x14" + hashlib.sha256(script_hex).digest()[:20] + "\x87"
+
+def push_data(data):
+	if len(data) < 0x4c:
+		return chr(len(data)) + data
+	return "\x4c" + chr(len(data)) + data
+
+
+class BenchBitcoin:
+	def __init__(self, settings):
+		self.settings = settings
+		self.functionary_script = p2sh_script_for_address(settings.redeem_script_address)
+		self.block_hashes = []
+		self.blocks = {}
+		self.txs = {}
+		self.spent = set()
+		self.mempool = []
+		# The wallet: watched scriptPubKeys, every P2SH output ever mined
+		# ((txid, vout) -> (value, script)) and outputs locked by lockunspent
+		self.watched = set()
+		self.p2sh_outputs = {}
+		self.locked = set()
+
+	def mine(self, txs):
+		# txs are serialized transactions, any which conflict with the chain are dropped
+		included = []
+		for data in txs:
+			(inputs, _) = deser_tx(data)
+			outpoints = [(inp[0], inp[1]) for inp in inputs]
+			if any([outpoint in self.spent for outpoint in outpoints]):
+				continue
+			self.spent.update(outpoints)
+			txid = txid_of(data)
+			self.txs[txid] = data
+			for n, output in enumerate(deser_tx(data)[1]):
+				if len(output[1]) == 23 and output[1].startswith("\xa9\x14"):
+					self.p2sh_outputs[(txid, n)] = output
+			included.append(data)
+		header = struct.pack("<I", len(self.block_hashes)) + "\x00" * 76
+		block_hash = double_sha256(header)[::-1].encode("hex")
+		self.block_hashes.append(block_hash)
+		self.blocks[block_hash] = header + ser_varint(len(included)) + "".join(included)
+		return len(included)
+
+	def decode(self, data):
+		(inputs, outputs) = deser_tx(data)
+		vin = []
+		for (txid, vout, script_sig) in inputs:
+			if txid == "00" * 32:
+				vin.append({"coinbase": script_sig.encode("hex")})
+			else:
+				vin.append({"txid": txid, "vout": vout, "scriptSig": {"hex": script_sig.encode("hex")}})
+		vout = []
+		for n, (value, script) in enumerate(outputs):
+			script_pubkey = {"hex": script.encode("hex"), "type": "nonstandard"}
+			if script == self.functionary_script:
+				script_pubkey.update({"type": "scripthash", "addresses": [self.settings.redeem_script_address]})
+			elif len(script) == 23 and script.startswith("\xa9\x14") and script.endswith("\x87"):
+				script_pubkey.update({"type": "scripthash", "addresses": ["bench-" + script[2:22].encode("hex")]})
+			vout.append({"value": decimal.Decimal(value) / COIN, "n": n, "scriptPubKey": script_pubkey})
+		return {"txid": txid_of(data), "vin": vin, "vout": vout}
+
+	def getblockcount(self):
+		return len(self.block_hashes) - 1
+
+	def getblockhash(self, height):
+		return self.block_hashes[height]
+
+	def getblock(self, block_hash, verbose=True):
+		check(not verbose)
+		return self.blocks[block_hash].encode("hex")
+
+	def getrawtransaction(self, txid, verbose=0):
+		check(verbose)
+		return self.decode(self.txs[txid])
+
+	def decoderawtransaction(self, tx_hex):
+		return self.decode(tx_hex.decode("hex"))
+
+	def gettxout(self, txid, vout, include_mempool=True):
+		if txid not in self.txs or (txid, vout) in self.spent:
+			return None
+		return {"value": self.decode(self.txs[txid])["vout"][vout]["value"]}
+
+	def signrawtransaction(self, tx_hex, redeem_scripts=None, private_keys=None):
+		data = tx_hex.decode("hex")
+		if redeem_scripts == None or len(redeem_scripts) == 0:
+			# Combining: take the first of the concatenated copies as complete
+			return {"hex": parse_tx(data)[0].data.encode("hex"), "complete": True}
+		(inputs, outputs) = deser_tx(data)
+		scripts = dict([((r["txid"], r["vout"]), r["redeemScript"]) for r in redeem_scripts])
+		signed = []
+		for (txid, vout, script_sig) in inputs:
+			redeem_script = scripts[(txid, vout)].decode("hex")
+			signed.append((txid, vout, "\x00" + ("\x47" + "\x30" * 71) * self.settings.sigs_required + push_data(redeem_script)))
+		return {"hex": ser_tx(signed, outputs).encode("hex"), "complete": False}
+
+	def sendrawtransaction(self, tx_hex):
+		self.mempool.append(tx_hex.decode("hex"))
+		return txid_of(self.mempool[-1])
+
+	def importaddress(self, script, label="", rescan=True, p2sh=False):
+		check(p2sh)
+		if script == self.settings.redeem_script:
+			self.watched.add(self.functionary_script)
+		else:
+			self.watched.add(fake_p2sh(script))
+
+	def lockunspent(self, unlock, inputs):
+		outpoints = set([(inp["txid"], inp["vout"]) for inp in inputs])
+		if unlock:
+			self.locked.difference_update(outpoints)
+		else:
+			self.locked.update(outpoints)
+
+	def fundrawtransaction(self, tx_hex, include_watching=False):
+		# Adds confirmed, unlocked watched outputs (largest first) and a change
+		# output at the end, paying 1 satoshi per unsigned byte
+		check(include_watching)
+		(inputs, outputs) = deser_tx(tx_hex.decode("hex"))
+		in_mempool = set([(inp[0], inp[1]) for data in self.mempool for inp in deser_tx(data)[0]])
+		in_tx = set([(inp[0], inp[1]) for inp in inputs])
+		coins = [(value, outpoint) for (outpoint, (value, script)) in self.p2sh_outputs.iteritems()
+			if script in self.watched and outpoint not in self.spent and outpoint not in self.locked and outpoint not in in_mempool and outpoint not in in_tx]
+		coins.sort(reverse=True)
+		inputs_value = sum([self.p2sh_outputs[outpoint][0] for outpoint in in_tx])
+		outputs_value = sum([output[0] for output in outputs])
+		while True:
+			fee = len(ser_tx(inputs, outputs)) + 32
+			if len(inputs) != 0 and inputs_value >= outputs_value + fee:
+				break
+			if len(coins) == 0:
+				raise Exception("Insufficient funds")
+			(value, (txid, vout)) = coins.pop(0)
+			inputs.append((txid, vout, ""))
+			inputs_value += value
+		outputs.append((inputs_value - outputs_value - fee, self.functionary_script))
+		return {"hex": ser_tx(inputs, outputs).encode("hex"), "fee": decimal.Decimal(fee) / COIN, "changepos": len(outputs) - 1}
+
+	def batch_(self, calls):
+		return [getattr(self, call[0])(*call[1:]) for call in calls]
+
+
+class BenchSidechain:
+	def __init__(self):
+		self.blocks = []
+		self.txs = {}
+
+	def add_block(self, txs):
+		for tx in txs:
+			self.txs[tx["txid"]] = tx
+		self.blocks.append([tx["txid"] for tx in txs])
+
+	def getblockcount(self):
+		return len(self.blocks) - 1
+
+	def getblockhash(self, height):
+		return "%064x" % height
+
+	def getblock(self, block_hash):
+		return {"tx": self.blocks[int(block_hash, 16)]}
+
+	def getrawtransaction(self, txid, verbose=0):
+		return self.txs[txid]
+
+	def gettxout(self, txid, vout, include_mempool=True):
+		# Every peg-in fraud proof made it in
+		return None
+
+	def batch_(self, calls):
+		return [getattr(self, call[0])(*call[1:]) for call in calls]
+
+
+class BenchTools:
+	# Stand-ins for bitcoin-tx and contracthashtool, taking the same arguments
+	def __init__(self, settings):
+		self.settings = settings
+
+	def modified_redeem_script(self, contract):
+		# Tweak the first pubkey, as contracthashtool would
+		return self.settings.redeem_script[:6] + hashlib.sha256(contract).hexdigest() + self.settings.redeem_script[70:]
+
+	def contracthashtool(self, args):
+		args = args.split(" ")
+		lines = [""] * 4
+		if "-g" in args:
+			lines[2 + self.settings.is_testnet] = "Modified redeem script: " + self.modified_redeem_script(args[args.index("-f") + 1])
+		else:
+			lines[0 + self.settings.is_testnet] = "Private key is: bench-key-" + args[-1]
+		return lines
+
+	def bitcoin_tx(self, args):
+		args = shlex.split(args)
+		if args[0] == "-create":
+			(inputs, outputs) = ([], [])
+		else:
+			(inputs, outputs) = deser_tx(args[0].decode("hex"))
+		for arg in args[1:]:
+			(op, value) = arg.split("=", 1)
+			if op == "in":
+				(txid, vout) = value.split(":")
+				inputs.append((txid, int(vout), ""))
+			elif op == "delout":
+				del outputs[int(value)]
+			else:
+				(amount, dest) = value.split(":", 1)
+				amount = int(decimal.Decimal(amount) * COIN)
+				if op == "outaddr":
+					check(dest == self.settings.redeem_script_address)
+					outputs.append((amount, p2sh_script_for_address(dest)))
+				else:
+					# outscript=<value>:"OP_HASH160 0x14<hash> OP_EQUAL"
+					outputs.append((amount, "\xa9\x14" + dest.split(" ")[1][4:].decode("hex") + "\x87"))
+		return ser_tx(inputs, outputs).encode("hex")
+
+
+def check(cond):
+	if not cond:
+		raise Exception("benchmark stand-in assertion failed")
+
+def random_txid(rng):
+	return "%064x" % rng.getrandbits(256)
+
+def noise_tx(rng):
+	return ser_tx([(random_txid(rng), rng.randint(0, 3), "\x51" * rng.randint(70, 110))], [(rng.randint(1, 10 * COIN), "\x76\xa9\x14" + random_txid(rng)[:40].decode("hex") + "\x88\xac") for i in range(rng.randint(1, 3))])
+
+def build_histories(settings, args, tools):
+	# Returns (sidechain, bitcoin, withdraw_count)
+	rng = random.Random(args.seed)
+	sidechain = BenchSidechain()
+	bitcoin = BenchBitcoin(settings)
+	functionary_script = p2sh_script_for_address(settings.redeem_script_address)
+
+	# Peg-in deposits and donations straight to the functionary address go in
+	# the bitcoin chain, among plenty of unrelated traffic
+	bitcoin_blocks = [[] for i in range(args.bitcoin_blocks)]
+	pegins = []
+	for i in range(args.pegins):
+		contract = "%040x" % rng.getrandbits(160)
+		value = rng.randint(1, 50) * COIN
+		data = ser_tx([(random_txid(rng), 0, "\x51" * 100)], [(value, fake_p2sh(tools.modified_redeem_script(contract)))])
+		pegins.append((contract, txid_of(data)))
+		bitcoin_blocks[rng.randrange(args.bitcoin_blocks)].append(data)
+	for i in range(args.donations):
+		data = ser_tx([(random_txid(rng), 0, "\x51" * 100)], [(rng.randint(1, 10) * COIN / 100, functionary_script)])
+		bitcoin_blocks[rng.randrange(args.bitcoin_blocks)].append(data)
+	for height, txs in enumerate(bitcoin_blocks):
+		coinbase = ser_tx([("00" * 32, 0xffffffff, struct.pack("<I", height))], [(25 * COIN, "\x51")])
+		txs.extend([noise_tx(rng) for i in range(args.bitcoin_noise)])
+		rng.shuffle(txs)
+		bitcoin.mine([coinbase] + txs)
+
+	# Peg-in claims, withdraws (some reusing an earlier address, so they have
+	# to wait their turn) and fee donations go in the sidechain
+	sidechain_blocks = [[] for i in range(args.sidechain_blocks)]
+	for (contract, bitcoin_txid) in pegins:
+		tx = {"txid": random_txid(rng), "vin": [{"scriptSig": {"asm": "0 0 %s" % contract}}], "vout": [
+			{"value": decimal.Decimal(0), "scriptPubKey": {"type": "withdrawout", "asm": " ".join(["0", "0", bitcoin_txid, "0"] + ["0"] * 12)}}]}
+		sidechain_blocks[rng.randrange(args.sidechain_blocks)].append(tx)
+	withdraw_contracts = []
+	for i in range(args.withdraws):
+		if len(withdraw_contracts) != 0 and rng.random() < args.repeat_address:
+			contract = rng.choice(withdraw_contracts)
+		else:
+			contract = "%040x" % rng.getrandbits(160)
+			withdraw_contracts.append(contract)
+		asm = "50325348%s OP_DROP %s %s OP_WITHDRAWPROOFVERIFY" % (contract, settings.inverse_bitcoin_genesis_hash, settings.secondScriptPubKeyHash)
+		value = decimal.Decimal(rng.randint(1, 100)) / 100
+		tx = {"txid": random_txid(rng), "vin": [], "vout": [{"value": value, "scriptPubKey": {"type": "withdraw", "asm": asm}}]}
+		sidechain_blocks[rng.randrange(args.sidechain_blocks)].append(tx)
+	for i in range(args.donations):
+		tx = {"txid": random_txid(rng), "vin": [], "vout": [{"value": decimal.Decimal("0.001"), "scriptPubKey": {"type": "nulldata"}}]}
+		sidechain_blocks[rng.randrange(args.sidechain_blocks)].append(tx)
+	# Withdraws need 8 confirmations before they are proposed (and the scan
+	# starts after the genesis block)
+	for txs in [[]] + sidechain_blocks + [[] for i in range(10)]:
+		txs = txs + [{"txid": random_txid(rng), "vin": [], "vout": [{"value": decimal.Decimal(1), "scriptPubKey": {"type": "pubkeyhash"}}]} for i in range(args.sidechain_noise)]
+		sidechain.add_block(txs)
+
+	return (sidechain, bitcoin, args.withdraws)
+
+
+class Quiet:
+	# withdrawwatch logs every UTXO and withdraw; keep that off the terminal
+	def __enter__(self):
+		self.stdout = sys.stdout
+		sys.stdout = open(os.devnull, "w")
+
+	def __exit__(self, exc_type, exc_value, tb):
+		sys.stdout.close()
+		sys.stdout = self.stdout
+		return False
+
+def max_rss_mib():
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def latency_summary(samples):
+	samples = sorted(samples)
+	if len(samples) == 0:
+		return {"count": 0, "avg": 0.0, "p50": 0.0, "max": 0.0}
+	return {"count": len(samples), "avg": sum(samples) / len(samples), "p50": samples[len(samples) / 2], "max": samples[-1]}
+
+def run(args):
+	FedpegConstants.self_funded = not args.wallet_funded
+	FedpegConstants.scanner_threads = args.scanner_threads
+	settings = FedpegConstants()
+	tools = BenchTools(settings)
+
+	start = time()
+	(sidechain, bitcoin, withdraw_count) = build_histories(settings, args, tools)
+	results = {"setup_seconds": time() - start, "workload": workload(args)}
+
+	# withdrawwatch keeps its journals in the working directory
+	workdir = tempfile.mkdtemp(prefix="bench_withdrawwatch")
+	cwd = os.getcwd()
+	os.chdir(workdir)
+	try:
+		import withdrawwatch as ww
+		from metrics import TimedProxy
+		ww.sidechain.factory = lambda: TimedProxy(sidechain, "sidechain")
+		ww.bitcoin.factory = lambda: TimedProxy(bitcoin, "bitcoin")
+		ww.run_bitcoin_tx = tools.bitcoin_tx
+		ww.run_contracthashtool = tools.contracthashtool
+		ww.start_scanner_pool()
+
+		sidechain_tip = sidechain.getblockcount()
+		start = time()
+		with Quiet():
+			ww.process_sidechain_blockchain(1, sidechain_tip + 1)
+			ww.process_confirmed_sidechain_blockchain(1, sidechain_tip - 4)
+		elapsed = time() - start
+		results["sidechain_blocks_per_second"] = sidechain_tip / elapsed
+		results["max_rss_mib_after_sidechain_scan"] = max_rss_mib()
+
+		bitcoin_tip = bitcoin.getblockcount()
+		start = time()
+		with Quiet():
+			ww.process_confirmed_bitcoin_blockchain(0, bitcoin_tip + 1)
+		elapsed = time() - start
+		results["bitcoin_blocks_per_second"] = (bitcoin_tip + 1) / elapsed
+		results["max_rss_mib_after_bitcoin_scan"] = max_rss_mib()
+		if args.wallet_funded:
+			# As withdrawwatch's startup does, once the scans are done
+			ww.import_bitcoin_script(settings.redeem_script)
+
+		class BenchController(ww.WatchPeerController):
+			# No sockets, the benchmark calls the round callbacks itself
+			def __init__(self):
+				self.round_local_txs = {}
+
+		controller = BenchController()
+		peer_count = len(settings.nodes) - 1
+		timings = {"gen_master_msg": [], "recv_master_msg": [], "round_done": [], "mine_and_scan": []}
+		completed = 0
+		rounds = 0
+		idle_rounds = 0
+		# [{"round", "phase", "error"}, ...], as RotatingConsensus would have
+		# logged them before moving on to the next round
+		failures = []
+		while rounds < args.max_rounds and idle_rounds < 3:
+			rounds += 1
+			controller.round_id = rounds
+			controller.done_round_id = rounds
+			with Quiet():
+				msg = None
+				phase = "gen_master_msg"
+				try:
+					start = time()
+					msg = controller.gen_master_msg()
+					timings["gen_master_msg"].append(time() - start)
+					if msg != None:
+						phase = "recv_master_msg"
+						start = time()
+						controller.recv_master_msg(msg)
+						timings["recv_master_msg"].append(time() - start)
+						peer_msg = json.dumps(controller.round_local_txs[rounds])
+						phase = "round_done"
+						start = time()
+						controller.round_done([("peer%d" % i, peer_msg) for i in range(peer_count)])
+						timings["round_done"].append(time() - start)
+				except Exception as e:
+					failures.append({"round": rounds, "phase": phase, "error": str(e)})
+					controller.round_failed()
+
+				# Hold transactions back for --withhold rounds, so the next rounds
+				# have to double-spend them
+				if rounds % (args.withhold + 1) == 0 or msg == None:
+					start = time()
+					pending_before = len(ww.outputs_pending) + sum([len(x) for x in ww.outputs_waiting.values()])
+					bitcoin.mine(bitcoin.mempool)
+					bitcoin.mempool = []
+					ww.process_confirmed_bitcoin_blockchain(bitcoin.getblockcount(), bitcoin.getblockcount() + 1)
+					pending_after = len(ww.outputs_pending) + sum([len(x) for x in ww.outputs_waiting.values()])
+					completed += pending_before - pending_after
+					timings["mine_and_scan"].append(time() - start)
+			if msg == None or (len(failures) != 0 and failures[-1]["round"] == rounds):
+				idle_rounds += 1
+			else:
+				idle_rounds = 0
+
+		results["rounds"] = rounds
+		results["withdraws"] = withdraw_count
+		results["withdraws_completed"] = completed
+		results["round_failures"] = failures
+		for name in timings:
+			results["%s_ms" % name] = latency_summary([t * 1000 for t in timings[name]])
+		results["counters"] = ww.metrics.snapshot()["counters"]
+		results["max_rss_mib"] = max_rss_mib()
+	finally:
+		os.chdir(cwd)
+		shutil.rmtree(workdir)
+	return results
+
+def workload(args):
+	# Results are only comparable between runs with the same workload
+	return dict([(k, v) for (k, v) in vars(args).items() if k not in ("save", "baseline", "tolerance")])
+
+# (result key, whether larger is better)
+GATED = [("sidechain_blocks_per_second", True), ("bitcoin_blocks_per_second", True), ("gen_master_msg_ms.avg", False), ("round_done_ms.avg", False), ("max_rss_mib", False)]
+
+def lookup(results, key):
+	for part in key.split("."):
+		results = results[part]
+	return results
+
+def compare(results, baseline, tolerance):
+	# Returns a list of regressions, as printable strings
+	regressions = []
+	for (key, larger_is_better) in GATED:
+		(now, then) = (lookup(results, key), lookup(baseline, key))
+		if then == 0:
+			continue
+		change = (now - then) / float(then)
+		if (larger_is_better and change < -tolerance) or (not larger_is_better and change > tolerance):
+			regressions.append("%s: %.3f -> %.3f (%+.1f%%)" % (key, then, now, change * 100))
+	return regressions
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Benchmark withdrawwatch against synthetic chains")
+	parser.add_argument("--sidechain-blocks", type=int, default=500)
+	parser.add_argument("--sidechain-noise", type=int, default=20, help="unrelated transactions per sidechain block")
+	parser.add_argument("--bitcoin-blocks", type=int, default=200)
+	parser.add_argument("--bitcoin-noise", type=int, default=500, help="unrelated transactions per bitcoin block")
+	parser.add_argument("--pegins", type=int, default=500)
+	parser.add_argument("--withdraws", type=int, default=1000)
+	parser.add_argument("--repeat-address", type=float, default=0.05, help="fraction of withdraws reusing an earlier address")
+	parser.add_argument("--donations", type=int, default=50)
+	parser.add_argument("--withhold", type=int, default=1, help="rounds each batch of withdraw transactions goes unmined, forcing double-spend retries")
+	parser.add_argument("--max-rounds", type=int, default=200)
+	parser.add_argument("--scanner-threads", type=int, default=1)
+	parser.add_argument("--wallet-funded", action="store_true", help="fund withdraws through the (stand-in) bitcoind wallet instead of self-funding")
+	parser.add_argument("--seed", type=int, default=1)
+	parser.add_argument("--save", help="write the results to this file")
+	parser.add_argument("--baseline", help="compare against results saved by an earlier run")
+	parser.add_argument("--tolerance", type=float, default=0.2, help="allowed fractional regression against --baseline")
+	args = parser.parse_args()
+
+	results = run(args)
+	print(json.dumps(results, indent=1, sort_keys=True))
+
+	if args.save != None:
+		with open(args.save, "w") as f:
+			json.dump(results, f, indent=1, sort_keys=True)
+
+	failed = False
+	for failure in results["round_failures"]:
+		print("Round %(round)d failed in %(phase)s: %(error)s" % failure)
+	if results["withdraws_completed"] != results["withdraws"]:
+		print("Only %d of %d withdraws completed" % (results["withdraws_completed"], results["withdraws"]))
+		failed = True
+	if args.baseline != None:
+		with open(args.baseline) as f:
+			baseline = json.load(f)
+		if baseline["workload"] != results["workload"]:
+			print("Baseline was run with a different workload: %s" % json.dumps(baseline["workload"], sort_keys=True))
+			sys.exit(2)
+		regressions = compare(results, baseline, args.tolerance)
+		for regression in regressions:
+			print("REGRESSION %s" % regression)
+		failed = failed or len(regressions) != 0
+	sys.exit(1 if failed else 0)
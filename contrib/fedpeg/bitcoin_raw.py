@@ -0,0 +1,102 @@
+#!/usr/bin/env python2
+
+# Just enough parsing of serialized bitcoin blocks and transactions for
+# withdrawwatch to pick out the few transactions worth a full decode.
+# Txids are 32-byte binary strings in display order, as in withdraw_records.
+
+import hashlib, struct
+
+def read_varint(data, pos):
+	n = ord(data[pos])
+	if n < 0xfd:
+		return (n, pos + 1)
+	if n == 0xfd:
+		return (struct.unpack_from("<H", data, pos + 1)[0], pos + 3)
+	if n == 0xfe:
+		return (struct.unpack_from("<I", data, pos + 1)[0], pos + 5)
+	return (struct.unpack_from("<Q", data, pos + 1)[0], pos + 9)
+
+def double_sha256(data):
+	return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+
+class RawTx(object):
+	# inputs is a list of (prev_txid, prev_vout, scriptSig)
+	# output_scripts is a list of scriptPubKeys
+	__slots__ = ("data", "txid", "inputs", "output_scripts")
+
+	def __init__(self, data, txid, inputs, output_scripts):
+		self.data = data
+		self.txid = txid
+		self.inputs = inputs
+		self.output_scripts = output_scripts
+
+
+def parse_tx(data, pos=0):
+	# Returns (RawTx, position after the transaction)
+	start = pos
+	pos += 4
+	has_witness = data[pos] == "\x00" and data[pos + 1] == "\x01"
+	if has_witness:
+		pos += 2
+	body_start = pos
+
+	(input_count, pos) = read_varint(data, pos)
+	inputs = []
+	for i in range(input_count):
+		prev_txid = data[pos:pos + 32][::-1]
+		prev_vout = struct.unpack_from("<I", data, pos + 32)[0]
+		(script_len, pos) = read_varint(data, pos + 36)
+		inputs.append((prev_txid, prev_vout, data[pos:pos + script_len]))
+		pos += script_len + 4
+
+	(output_count, pos) = read_varint(data, pos)
+	output_scripts = []
+	for i in range(output_count):
+		(script_len, pos) = read_varint(data, pos + 8)
+		output_scripts.append(data[pos:pos + script_len])
+		pos += script_len
+	body_end = pos
+
+	if has_witness:
+		for i in range(input_count):
+			(item_count, pos) = read_varint(data, pos)
+			for j in range(item_count):
+				(item_len, pos) = read_varint(data, pos)
+				pos += item_len
+	pos += 4
+
+	# The txid never commits to witness data
+	if has_witness:
+		txid = double_sha256(data[start:start + 4] + data[body_start:body_end] + data[pos - 4:pos])[::-1]
+	else:
+		txid = double_sha256(data[start:pos])[::-1]
+	return (RawTx(data[start:pos], txid, inputs, output_scripts), pos)
+
+def parse_block(data):
+	# Returns the list of RawTx in a serialized block
+	(tx_count, pos) = read_varint(data, 80)
+	txs = []
+	for i in range(tx_count):
+		(tx, pos) = parse_tx(data, pos)
+		txs.append(tx)
+	return txs
+
+
+B58_DIGITS = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+
+def base58check_decode(s):
+	n = 0
+	for c in s:
+		n = n * 58 + B58_DIGITS.index(c)
+	h = "%x" % n
+	if len(h) % 2 != 0:
+		h = "0" + h
+	data = "\x00" * (len(s) - len(s.lstrip("1"))) + h.decode("hex")
+	if double_sha256(data[:-4])[:4] != data[-4:]:
+		raise Exception("Bad base58 checksum in %s" % s)
+	return data[:-4]
+
+def p2sh_script_for_address(address):
+	# OP_HASH160 <20-byte hash> OP_EQUAL
+	return "\xa9\x14" + base58check_decode(address)[1:] + "\x87"
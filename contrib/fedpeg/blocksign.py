@@ -4,43 +4,47 @@ import sys, os, json, traceback, decimal
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../../python-bitcoinrpc"))
 from bitcoinrpc.authproxy import AuthServiceProxy, JSONRPCException
 from rotating_consensus import RotatingConsensus
-from threading import Lock, current_thread
-from time import sleep
+from threading import Lock
 from constants import FedpegConstants
+from metrics import metrics, start_exporter, TimedProxy
+from workers import ConnectionRegistry
 from httplib import CannotSendRequest
 
 
 settings = FedpegConstants()
 port = 14252
 
-sidechain = AuthServiceProxy(settings.sidechain_url)
+def sidechain_connection():
+	return TimedProxy(AuthServiceProxy(settings.sidechain_url), "sidechain")
+
+sidechain = ConnectionRegistry(sidechain_connection, "sidechain")
 
 class WatchPeerController(RotatingConsensus):
 	round_local_block_hex = ""
 
 	def gen_master_msg(self):
-		global sidechain
 		try:
-			self.round_local_block_hex = sidechain.getnewblockhex()
+			self.round_local_block_hex = sidechain.get().getnewblockhex()
 		except CannotSendRequest as e:
-			sidechain = AuthServiceProxy(settings.sidechain_url)
+			sidechain.reset()
 			return None
 		return self.round_local_block_hex
 
 	def recv_master_msg(self, msg):
 		self.round_local_block_hex = msg
-		return sidechain.signblock(msg)
+		return sidechain.get().signblock(msg)
 
 	def round_done(self, peer_messages):
-		mysig = sidechain.signblock(self.round_local_block_hex)
+		mysig = sidechain.get().signblock(self.round_local_block_hex)
 		peer_messages.append(("self", mysig))
 		sys.stdout.write("Got signatures from %s, now combining..." % str([x[0] for x in peer_messages if x[1][0] == "0" and x[1][1] == "0" and len(x[1]) == 132]))
 		sys.stdout.flush()
-		res = sidechain.combineblocksigs(self.round_local_block_hex, [x[1] for x in peer_messages])
+		res = sidechain.get().combineblocksigs(self.round_local_block_hex, [x[1] for x in peer_messages])
 		if res["complete"]:
 			sys.stdout.write("got completely signed block, submitting to sidechaind...")
 			sys.stdout.flush()
-			sidechain.submitblock(res["hex"])
+			sidechain.get().submitblock(res["hex"])
+			metrics.inc("blocks_submitted")
 			print("done")
 		else:
 			print("got incomplete block")
@@ -52,10 +56,18 @@ class WatchPeerController(RotatingConsensus):
 		self.round_local_block_hex = ""
 		return
 
-sidechain.importprivkey(settings.blocksigning_private_key)
+	# Blocks and signatures are hex, so send them as raw bytes
+	def encode_message(self, msg):
+		return str(msg).decode("hex")
 
-settings.nodes.remove(settings.my_node)
-WatchPeerController(settings.nodes, settings.my_node, port, 60, settings.socks_proxy)
+	def decode_message(self, payload):
+		return payload.encode("hex")
+
+sidechain.get().importprivkey(settings.blocksigning_private_key)
 
-while True:
-	sleep(10)
+start_exporter(settings.blocksign_metrics_port)
+
+settings.nodes.remove(settings.my_node)
+# Nothing else to do here, so run the rounds in the main thread
+controller = WatchPeerController(settings.nodes, settings.my_node, port, 60, settings.socks_proxy, start_thread=False, quorum=settings.consensus_quorum, compress=settings.consensus_compress, trace_file=settings.consensus_trace_file, liveness_slots=settings.consensus_liveness_slots, clock_sync=settings.consensus_clock_sync)
+controller.main_loop()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python2
+
+# An in-memory stand-in for ZmqTransport, so a whole federation of
+# RotatingConsensus nodes can run in one process against simulated time.
+# Every link between two nodes has its own latency, jitter and loss, and every
+# node's clock its own skew from simulated time. Nothing ever sleeps: the
+# Simulator jumps straight to the next phase deadline or message delivery, so
+# a day of 60 second rounds takes seconds.
+#
+# Nodes must be created with start_thread=False and the SimTransport from
+# SimNetwork.transport(), then handed to Simulator.add().
+
+import heapq, random
+from rotating_consensus import Peer, build_message, parse_message
+from metrics import metrics
+
+class Link:
+	def __init__(self, latency=0.05, jitter=0.0, loss=0.0):
+		self.latency = latency
+		self.jitter = jitter
+		self.loss = loss
+
+
+class SimNetwork:
+	def __init__(self, start=1500000000.0, seed=1):
+		self.now = start
+		self.rng = random.Random(seed)
+		self.default_link = Link()
+		# (from host, to host) -> Link
+		self.links = {}
+		self.transports = {}
+		# heap of (deliver at, sequence, to host, from host, frames)
+		self.deliveries = []
+		self.sequence = 0
+		self.sent = 0
+		self.dropped = 0
+
+	def set_link(self, from_host, to_host, link):
+		self.links[(from_host, to_host)] = link
+
+	def link(self, from_host, to_host):
+		return self.links.get((from_host, to_host), self.default_link)
+
+	def transport(self, host, peer_hosts, skew=0.0, compress=False):
+		transport = SimTransport(self, host, peer_hosts, skew, compress)
+		self.transports[host] = transport
+		return transport
+
+	def send(self, from_host, frames):
+		for to_host in self.transports:
+			if to_host == from_host:
+				continue
+			self.sent += 1
+			link = self.link(from_host, to_host)
+			if self.rng.random() < link.loss:
+				self.dropped += 1
+				continue
+			deliver_at = self.now + link.latency + self.rng.uniform(0, link.jitter)
+			self.sequence += 1
+			heapq.heappush(self.deliveries, (deliver_at, self.sequence, to_host, from_host, frames))
+
+	def next_delivery(self):
+		if len(self.deliveries) == 0:
+			return None
+		return self.deliveries[0][0]
+
+	def deliver(self):
+		# Hand every message which has arrived by now to its receiver
+		while len(self.deliveries) != 0 and self.deliveries[0][0] <= self.now:
+			(deliver_at, sequence, to_host, from_host, frames) = heapq.heappop(self.deliveries)
+			self.transports[to_host].receive(from_host, frames)
+
+
+class SimTransport:
+	def __init__(self, network, host, peer_hosts, skew, compress):
+		self.network = network
+		self.host = host
+		self.skew = skew
+		self.compress = compress
+		self.peers = [Peer(peer_host) for peer_host in peer_hosts]
+		self.peers_by_host = dict([(peer.host, peer) for peer in self.peers])
+		# Set to make this node go silent (it still receives)
+		self.offline = False
+
+	def time(self):
+		return self.network.now + self.skew
+
+	def send_message(self, msg_type, round_id, master, payload):
+		if not self.offline:
+			self.network.send(self.host, build_message(msg_type, round_id, master, payload, self.compress))
+
+	def receive(self, from_host, frames):
+		peer = self.peers_by_host.get(from_host)
+		if peer == None:
+			return
+		msg = parse_message(frames, self.time())
+		if msg == None:
+			metrics.inc("consensus.bad_messages")
+			return
+		metrics.inc("consensus.messages_received")
+		peer.receive(msg)
+
+	def poll_until(self, deadline, done=None):
+		# Simulated time only moves in Simulator.run(), which delivers messages
+		# as they arrive, so there is never anything to wait for here
+		return
+
+
+class Simulator:
+	def __init__(self, network):
+		self.network = network
+		self.nodes = []
+
+	def add(self, node):
+		self.nodes.append(node)
+
+	def run(self, until):
+		# Run every node until simulated time reaches until
+		while True:
+			self.network.deliver()
+			wake = []
+			for node in self.nodes:
+				# Deadlines are in the node's own (skewed, maybe corrected) time
+				wake.append(node.step() - (node.time() - self.network.now))
+			delivery = self.network.next_delivery()
+			if delivery != None:
+				wake.append(delivery)
+			next_wake = min(wake)
+			if next_wake >= until:
+				self.network.now = until
+				return
+			self.network.now = max(next_wake, self.network.now)
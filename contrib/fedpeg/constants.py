@@ -18,6 +18,32 @@ class FedpegConstants:
 	contracthashtool_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../../contracthashtool/contracthashtool")
 	is_testnet = 1
 
+	# Set this to have withdrawwatch fund and sign withdraws from its own view of
+	# the functionary UTXOs, with the keys above/derived from them, instead of via
+	# the bitcoind wallet. This skips all importaddress calls and the startup
+	# wallet rescan (bitcoind still needs -txindex).
+	self_funded = False
+
+	# Set this to have withdrawwatch watch the sidechain mempool for peg-in
+	# claims and do their contracthashtool runs, bitcoin parent tx fetches and
+	# importaddress calls before they are mined.
+	watch_sidechain_mempool = False
+
+	# Limits on each withdraw transaction withdrawwatch proposes, and on how many
+	# transactions one consensus round may carry. Eligible withdraws are packed
+	# oldest first, then largest first.
+	withdraw_tx_max_size = 100000
+	withdraw_tx_max_outputs = 250
+	withdraw_txs_per_round = 4
+
+	# Number of threads withdrawwatch uses to fetch and decode blocks while
+	# following the chains (1 fetches them serially in the main loop)
+	scanner_threads = 1
+
+	# Number of worker processes withdrawwatch uses to fetch and decode blocks
+	# during its initial chain scan (1 scans serially in the main process)
+	initial_sync_processes = 1
+
 	#Bitcoin:
 	bitcoin_genesis_hash = "000000000019d6689c085ae165831e934ff763ae46a2a6c172b3f1b60a8ce26f"
 	#Testnet:
@@ -31,6 +57,33 @@ class FedpegConstants:
 	socks_proxy = None
 	#socks_proxy = "127.0.0.1:9050"
 
+	# Number of peer responses after which a consensus round is finished early
+	# (None waits for every peer, or until interval/2)
+	consensus_quorum = None
+
+	# zlib-compress large consensus messages (peers accept either form)
+	consensus_compress = True
+
+	# Append a JSON line per consensus round to this file (None keeps traces in memory only)
+	consensus_trace_file = None
+
+	# Let withdrawwatch's next master build its proposal, and peers sign the
+	# next round, while the previous round's transactions are still being
+	# combined and broadcast
+	consensus_pipeline = False
+
+	# Skip a functionary's turn as master once we have not heard from it for
+	# this many rounds (None always waits for it)
+	consensus_liveness_slots = 3
+
+	# Estimate peers' clock offsets from heartbeats and time rounds by the
+	# median clock, so a few seconds of skew does not cost rounds
+	consensus_clock_sync = True
+
+	# Set these to serve JSON metrics on http://127.0.0.1:<port>/ (None disables)
+	withdrawwatch_metrics_port = None
+	blocksign_metrics_port = None
+
 	def __init__(self):
 		# Derived constants (dont touch)
 		self.testnet_arg = ""
@@ -0,0 +1,173 @@
+#!/usr/bin/env python2
+
+# Operational metrics for the fedpeg daemons, served as JSON over a local HTTP port.
+# Everything records into the module-global registry "metrics".
+
+import json, threading
+from time import time
+from collections import deque
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+RATE_WINDOW = 60
+
+class Metrics:
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.start_time = time()
+		self.counters = {}
+		# name -> deque([[second, count], ...]) over the last RATE_WINDOW seconds
+		self.rate_buckets = {}
+		self.gauges = {}
+		self.gauge_callbacks = {}
+		# name -> [count, total_seconds, max_seconds, last_seconds]
+		self.timers = {}
+
+	def inc(self, name, amount=1):
+		now = int(time())
+		self.lock.acquire()
+		try:
+			self.counters[name] = self.counters.get(name, 0) + amount
+			if name not in self.rate_buckets:
+				self.rate_buckets[name] = deque(maxlen=RATE_WINDOW)
+			buckets = self.rate_buckets[name]
+			if len(buckets) != 0 and buckets[-1][0] == now:
+				buckets[-1][1] += amount
+			else:
+				buckets.append([now, amount])
+		finally:
+			self.lock.release()
+
+	def set_gauge(self, name, value):
+		self.lock.acquire()
+		self.gauges[name] = value
+		self.lock.release()
+
+	def gauge_callback(self, name, callback):
+		# callback() is evaluated whenever metrics are read
+		self.lock.acquire()
+		self.gauge_callbacks[name] = callback
+		self.lock.release()
+
+	def observe(self, name, seconds):
+		self.lock.acquire()
+		try:
+			if name not in self.timers:
+				self.timers[name] = [0, 0.0, 0.0, 0.0]
+			timer = self.timers[name]
+			timer[0] += 1
+			timer[1] += seconds
+			timer[2] = max(timer[2], seconds)
+			timer[3] = seconds
+		finally:
+			self.lock.release()
+
+	def timed(self, name):
+		return Timer(self, name)
+
+	def snapshot(self):
+		now = time()
+		self.lock.acquire()
+		try:
+			rates = {}
+			for name in self.rate_buckets:
+				total = sum([b[1] for b in self.rate_buckets[name] if b[0] > now - RATE_WINDOW])
+				rates[name] = float(total) / min(RATE_WINDOW, max(now - self.start_time, 1))
+			timers = {}
+			for name in self.timers:
+				timer = self.timers[name]
+				timers[name] = {"count": timer[0], "total": timer[1], "avg": timer[1] / timer[0], "max": timer[2], "last": timer[3]}
+			gauges = dict(self.gauges)
+			callbacks = dict(self.gauge_callbacks)
+			counters = dict(self.counters)
+		finally:
+			self.lock.release()
+
+		for name in callbacks:
+			try:
+				gauges[name] = callbacks[name]()
+			except Exception as e:
+				gauges[name] = "error: %s" % str(e)
+
+		return {"uptime": now - self.start_time, "counters": counters, "rates_per_second": rates, "gauges": gauges, "timers": timers}
+
+metrics = Metrics()
+
+
+class Timer:
+	def __init__(self, registry, name):
+		self.registry = registry
+		self.name = name
+
+	def __enter__(self):
+		self.start = time()
+		return self
+
+	def __exit__(self, exc_type, exc_value, tb):
+		self.registry.observe(self.name, time() - self.start)
+		return False
+
+
+class TimedLock:
+	# Wraps a threading.Lock, recording how long callers wait for it and hold it
+	def __init__(self, lock, name):
+		self.lock = lock
+		self.name = name
+		self.acquired_at = None
+
+	def acquire(self):
+		start = time()
+		self.lock.acquire()
+		self.acquired_at = time()
+		metrics.observe("%s.wait" % self.name, self.acquired_at - start)
+		return True
+
+	def release(self):
+		held = time() - self.acquired_at
+		self.lock.release()
+		metrics.observe("%s.hold" % self.name, held)
+
+	def __enter__(self):
+		return self.acquire()
+
+	def __exit__(self, exc_type, exc_value, tb):
+		self.release()
+		return False
+
+
+class TimedProxy:
+	# Wraps an AuthServiceProxy, recording per-method RPC latency
+	def __init__(self, proxy, name):
+		self.proxy = proxy
+		self.name = name
+
+	def __getattr__(self, method):
+		if method.startswith("__") and method.endswith("__"):
+			raise AttributeError
+		call = getattr(self.proxy, method)
+		timer_name = "rpc.%s.%s" % (self.name, method)
+		def timed_call(*args):
+			with metrics.timed(timer_name):
+				return call(*args)
+		return timed_call
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+	def do_GET(self):
+		body = json.dumps(metrics.snapshot(), indent=1, sort_keys=True, default=str)
+		self.send_response(200)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		return
+
+def start_exporter(port):
+	# Serve metrics as JSON on http://127.0.0.1:port/ (port == None disables)
+	if port == None:
+		return
+	server = HTTPServer(("127.0.0.1", port), MetricsRequestHandler)
+	thread = threading.Thread(target=server.serve_forever)
+	thread.daemon = True
+	thread.start()
@@ -2,132 +2,615 @@
 
 from time import sleep, time
 import socket
-import threading
+import threading, Queue
 import zmq
 import traceback
 
 
 # For error printing
-import sys, os
+import sys, os, struct, zlib, json
+from collections import deque
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../../python-bitcoinrpc"))
 from bitcoinrpc.authproxy import JSONRPCException
+from metrics import metrics
+from round_trace import RoundTracer
 
 zmq_context = zmq.Context()
-zmq_poller = zmq.Poller()
 
 if (zmq.zmq_version() < 4):
 	print("It is highly recommended you use a version of ZMQ > 4")
 
+# Messages are four ZMQ frames: the "42" topic, a header, the host of the
+# round's master and the payload bytes.
+# The header is (version, message type, flags, round id).
+MSG_TOPIC = "42"
+MSG_HEADER = struct.Struct("!BBBQ")
+MSG_VERSION = 2
+MSG_MASTER = 1
+MSG_RESPONSE = 2
+# Sent by everyone at the start of every round, so peers know we are up.
+# The payload is JSON {"sent": our clock, "echo": {host: [their heartbeat's
+# "sent", our clock when it arrived], ...}}, from which each peer estimates
+# its clock's offset from ours as NTP does.
+MSG_HEARTBEAT = 3
+# Clock offset samples kept per peer
+CLOCK_SAMPLES = 8
+# A peer's samples stop counting towards our clock this many of our rounds
+# after we took them (going by our round, not the sender's, so that a clock
+# which is badly off still hears fresh samples to correct itself with)
+CLOCK_SAMPLE_ROUNDS = 3
+# done() can become true without any message arriving (eg once the completion
+# thread finishes), so poll_until looks at it at least this often
+DONE_CHECK_INTERVAL = 0.1
+MSG_FLAG_ZLIB = 1
+# Smaller payloads are never worth compressing
+COMPRESS_MIN_SIZE = 256
+# Payloads are rejected above this size, compressed or not, so a small
+# compressed message cannot make us allocate gigabytes (withdrawwatch's
+# largest, withdraw_txs_per_round hex-encoded transactions, are under 1MB)
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+
+def build_message(msg_type, round_id, master, payload, compress=False):
+	# Returns the frames to send
+	flags = 0
+	if compress and len(payload) >= COMPRESS_MIN_SIZE:
+		compressed = zlib.compress(payload)
+		if len(compressed) < len(payload):
+			payload = compressed
+			flags = MSG_FLAG_ZLIB
+	metrics.inc("consensus.bytes_sent", len(payload))
+	return [MSG_TOPIC, MSG_HEADER.pack(MSG_VERSION, msg_type, flags, round_id), master, payload]
+
+def parse_message(frames, received_at):
+	# Returns (round_id, msg_type, payload, received_at, master), or None for
+	# anything malformed
+	if len(frames) != 4 or len(frames[1]) != MSG_HEADER.size:
+		return None
+	(version, msg_type, flags, round_id) = MSG_HEADER.unpack(frames[1])
+	if version != MSG_VERSION:
+		return None
+	payload = frames[3]
+	if len(payload) > MAX_MESSAGE_SIZE:
+		return None
+	if flags & MSG_FLAG_ZLIB:
+		try:
+			decompressor = zlib.decompressobj()
+			payload = decompressor.decompress(payload, MAX_MESSAGE_SIZE)
+		except zlib.error:
+			return None
+		if len(decompressor.unconsumed_tail) != 0:
+			return None
+	return (round_id, msg_type, payload, received_at, frames[2])
+
 class ConsensusPublisher:
-	def __init__(self, port):
+	def __init__(self, port, compress=False):
 		self.socket = zmq_context.socket(zmq.PUB)
 		self.socket.bind("tcp://*:%d" % port)
-		zmq_poller.register(self.socket, zmq.POLLOUT)
+		self.compress = compress
 
-	def send_message(self, msg):
-		self.socket.send("42 %s" % msg.encode("ascii", "strict"))
+	def send_message(self, msg_type, round_id, master, payload):
+		self.socket.send_multipart(build_message(msg_type, round_id, master, payload, self.compress))
 
-class ConsensusSocket:
-	def __init__(self, host, port, proxy):
+class Peer:
+	def __init__(self, host):
 		self.host = host
 		self.isSelf = False
+		# (round_id, msg_type, payload, received_at, master) tuples for this
+		# round or later ones, filled in by the transport through receive()
+		self.inbox = deque()
+		self.round_id = 0
+		# The latest round id this peer has sent us anything for (until our
+		# first round starts, we assume it is up). Going by the sender's round
+		# id, not ours when it arrived, every receiver agrees on it however
+		# messages straddle their round boundaries.
+		self.last_seen_round = None
+		# Heartbeats not yet looked at, and the last one's (sent, received_at)
+		self.heartbeats = deque(maxlen=CLOCK_SAMPLES)
+		self.last_heartbeat = None
+		self.clock = PeerClock()
+
+	def receive(self, msg):
+		# Nothing is kept for rounds after the next one (which pipelining can
+		# need early): a peer whose clock runs fast must neither fill our inbox
+		# nor have old proposals acted on, nor look live after it has died.
+		# Its heartbeats still count towards our clock, so if it is us who is
+		# behind, we can catch up.
+		if msg[0] > self.round_id + 1:
+			if msg[1] == MSG_HEARTBEAT:
+				self.heartbeats.append(msg)
+			else:
+				metrics.inc("consensus.future_messages")
+			return
+		if self.last_seen_round == None or msg[0] > self.last_seen_round:
+			self.last_seen_round = msg[0]
+		if msg[1] == MSG_HEARTBEAT:
+			self.heartbeats.append(msg)
+			return
+		if msg[0] < self.round_id:
+			metrics.inc("consensus.stale_messages")
+			return
+		self.inbox.append(msg)
+
+	def start_round(self, round_id):
+		# From now on, anything for an earlier round is dropped as it arrives.
+		# The inbox only holds what arrived early, so this is cheap.
+		self.round_id = round_id
+		if self.last_seen_round == None:
+			self.last_seen_round = round_id
+		for msg in list(self.inbox):
+			if msg[0] < round_id:
+				self.inbox.remove(msg)
+				metrics.inc("consensus.stale_messages")
+
+	def has_message(self, msg_type, round_id, master):
+		for msg in self.inbox:
+			if msg[1] == msg_type and msg[0] == round_id and msg[4] == master:
+				return True
+		return False
+
+	def read_message(self, msg_type, round_id, master):
+		# Never blocks: returns the oldest message of msg_type for round_id,
+		# under master, the transport has received from this peer, or None
+		for msg in self.inbox:
+			if msg[1] == msg_type and msg[0] == round_id and msg[4] == master:
+				self.inbox.remove(msg)
+				return msg
+		return None
+
+class PeerClock:
+	# NTP-style estimate of a peer's clock minus ours, trusting the sample
+	# with the shortest round trip, as it had the least room for asymmetry
+	def __init__(self):
+		self.samples = deque(maxlen=CLOCK_SAMPLES)
+
+	def add_sample(self, offset, delay, round_id):
+		self.samples.append((delay, offset, round_id))
+
+	def offset(self, since_round=None):
+		# Only samples taken in our round since_round or later count
+		samples = [sample for sample in self.samples if since_round == None or sample[2] >= since_round]
+		if len(samples) == 0:
+			return None
+		return min(samples)[1]
+
+class ConsensusSocket(Peer):
+	def __init__(self, host, port, proxy):
+		Peer.__init__(self, host)
 		self.sock = zmq_context.socket(zmq.SUB)
 		if proxy != None:
 			self.sock.setsockopt(zmq.SOCKS_PROXY, proxy)
 		self.sock.setsockopt(zmq.RECONNECT_IVL, 500)
 		self.sock.setsockopt(zmq.RECONNECT_IVL_MAX, 10000)
 		self.sock.connect("tcp://%s:%d" % (host, port))
-		self.sock.setsockopt(zmq.SUBSCRIBE, "42")
-		zmq_poller.register(self.sock, zmq.POLLIN)
-
-	def read_message(self):
-		if not dict(zmq_poller.poll()).has_key(self.sock):
-			return None
-		topic, msg = self.sock.recv().split(" ", 1)
-		return msg
+		self.sock.setsockopt(zmq.SUBSCRIBE, MSG_TOPIC)
 
 class Self:
 	def __init__(self, host):
 		self.host = host
 		self.isSelf = True
-	def read_message(self):
+		self.inbox = deque()
+	def has_message(self, msg_type, round_id, master):
+		return False
+	def read_message(self, msg_type, round_id, master):
 		return None
+	def start_round(self, round_id):
+		return
+
+class PeerPoller:
+	# Polls every peer's socket at once, filing what arrives into per-peer inboxes
+	def __init__(self, nodes):
+		self.poller = zmq.Poller()
+		self.nodes_by_socket = {}
+		for node in nodes:
+			if not node.isSelf:
+				self.poller.register(node.sock, zmq.POLLIN)
+				self.nodes_by_socket[node.sock] = node
+
+	def poll_until(self, deadline, done=None):
+		# Receive everything that arrives before deadline (a time()), or only
+		# what is already waiting if deadline has passed. Returns early once
+		# done() is true, if given.
+		while True:
+			timeout = max(deadline - time(), 0)
+			if done != None:
+				timeout = min(timeout, DONE_CHECK_INTERVAL)
+			for sock, event in self.poller.poll(timeout * 1000):
+				node = self.nodes_by_socket[sock]
+				while True:
+					try:
+						frames = sock.recv_multipart(zmq.NOBLOCK)
+					except zmq.Again:
+						break
+					msg = parse_message(frames, time())
+					if msg == None:
+						metrics.inc("consensus.bad_messages")
+						continue
+					metrics.inc("consensus.messages_received")
+					node.receive(msg)
+			if time() >= deadline or (done != None and done()):
+				return
+
+class ZmqTransport:
+	# How RotatingConsensus reaches its peers and tells the time. Anything with
+	# the same peers, time(), send_message() and poll_until() will do, eg the
+	# in-memory SimTransport in consensus_sim.py.
+	def __init__(self, nodes_list, port, proxy, compress=False):
+		self.peers = [ConsensusSocket(host, port, proxy) for host in nodes_list]
+		self.publisher = ConsensusPublisher(port, compress)
+		self.poller = PeerPoller(self.peers)
+		self.time = time
+
+	def send_message(self, msg_type, round_id, master, payload):
+		self.publisher.send_message(msg_type, round_id, master, payload)
+
+	def poll_until(self, deadline, done=None):
+		self.poller.poll_until(deadline, done)
 
 class RotatingConsensus:
-	def __init__(self, nodes_list, my_host, port, interval, proxy):
+	# Each round is a sequence of phases, each run by step() once its deadline
+	# has passed, or as soon as what it waits for has arrived. By default a
+	# thread drives the rounds; with start_thread=False the owner drives them
+	# itself by calling run_until() (or step() and self.transport.poll_until())
+	# from its own loop, in between other work.
+	# A round ends as soon as every peer (or quorum of them, if given) has
+	# responded, instead of always waiting until interval/2.
+	# With compress, large messages are sent zlib-compressed.
+	# Every round is traced (see round_trace.py), to trace_file too if given.
+	# Peers are reached over ZMQ unless another transport is given, in which
+	# case port, proxy and compress are the transport's business.
+	# With liveness_slots, everyone sends a heartbeat every round, and a
+	# peer we have heard nothing from for more than liveness_slots rounds is
+	# passed over as master, in favour of the next node in the rotation.
+	# With clock_sync, we estimate every peer's clock offset from heartbeats
+	# and run our rounds on the median of all the clocks, ours included, so
+	# every node agrees on the rounds even when their clocks do not.
+	# With pipeline, round_done runs in a separate completion thread while the
+	# next round goes ahead, and if we are the next master we generate our
+	# message as soon as the previous round has completed, sending it the
+	# moment our round starts. gen_master_msg never runs while a round_done
+	# is still going, but recv_master_msg may, so only for subclasses where
+	# that is safe, and whose round_done looks at self.done_round_id (the round
+	# it completes, set in either mode) rather than self.round_id.
+	def __init__(self, nodes_list, my_host, port, interval, proxy, start_thread=True, quorum=None, compress=False, trace_file=None, transport=None, pipeline=False, liveness_slots=None, clock_sync=False):
 		self.interval = interval
-		self.nodes = [Self(my_host)]
-		for host in nodes_list:
-			self.nodes.append(ConsensusSocket(host, port, proxy))
+		self.quorum = quorum
+		self.pipeline = pipeline
+		self.liveness_slots = liveness_slots
+		self.clock_sync = clock_sync
+		self.heartbeats = liveness_slots != None or clock_sync
+		if transport == None:
+			transport = ZmqTransport(nodes_list, port, proxy, compress)
+		self.transport = transport
+		# Seconds added to the transport's clock to get the federation's
+		self.clock_correction = 0.0
+		self.host = my_host
+		self.nodes = [Self(my_host)] + transport.peers
 		self.nodes.sort(key=lambda node: node.host)
-		self.publisher = ConsensusPublisher(port)
-		thread = threading.Thread(target=self.main_loop)
-		thread.daemon = True
-		thread.start()
+		metrics.gauge_callback("consensus.clock_correction", lambda: self.clock_correction)
+		metrics.gauge_callback("consensus.peer_clock_offsets", lambda: self._peer_clock_offsets())
+		metrics.gauge_callback("consensus.live_peers", lambda: [node.host for node in self.nodes if not node.isSelf and self._is_live(node, self.round_id)])
+
+		self.round_start = None
+		self.round_id = 0
+		self.master = None
+		# (round_id, message, seconds gen_master_msg took) prepared for our next round
+		self.prepared = None
+		self.done_round_id = None
+		self.tracer = RoundTracer(trace_file, clock=self.time)
+		metrics.gauge_callback("consensus.trace", self.tracer.summary)
+		self._set_phase(self._phase_start_round, self._next_round_start())
+
+		if pipeline:
+			self.completions = Queue.Queue()
+			# Rounds handed to the completion thread and not yet completed
+			self.completing = 0
+			self.completing_cond = threading.Condition()
+			metrics.gauge_callback("consensus.completions_pending", lambda: self.completing)
+			thread = threading.Thread(target=self.completion_loop, name="consensus-completion")
+			thread.daemon = True
+			thread.start()
+
+		if start_thread:
+			thread = threading.Thread(target=self.main_loop, name="consensus")
+			thread.daemon = True
+			thread.start()
+
+	def completion_loop(self):
+		while True:
+			(round_id, msgs, round_start, trace) = self.completions.get()
+			try:
+				self._complete_round(round_id, msgs, round_start, trace)
+			finally:
+				self.completing_cond.acquire()
+				try:
+					self.completing -= 1
+					self.completing_cond.notify_all()
+				finally:
+					self.completing_cond.release()
+
+	def _completions_done(self):
+		return self.completing == 0
+
+	def _wait_for_completions(self, until):
+		# Returns whether every round handed to the completion thread has
+		# completed, waiting for them until self.time() reaches until
+		self.completing_cond.acquire()
+		try:
+			while self.completing != 0 and self.time() < until:
+				self.completing_cond.wait(until - self.time())
+			return self.completing == 0
+		finally:
+			self.completing_cond.release()
+
+	def time(self):
+		return self.transport.time() + self.clock_correction
 
 	def main_loop(self):
 		while True:
-			sleep(self.interval - time() % self.interval)
-			start_time = int(time())
-			step = int(time()) % (self.interval * len(self.nodes)) / self.interval
-
-			for node in self.nodes:
-				msg = ""
-				while msg != None:
-					msg = node.read_message()
-
-			if self.nodes[step].isSelf:
-				print("Starting master round (as %s)" % self.nodes[step].host)
-
-				sleep(self.interval / 10)
-				msg = self._gen_master_msg()
-				if msg == None:
-					print("gen_master_msg threw or returned None")
-					self._round_failed()
-					continue
-				if time() - start_time > self.interval / 5:
-					print("gen_master_msg took longer than interval/5: Skipping round!")
-					self._round_failed()
-					continue
-				self.publisher.send_message(msg)
-				sleep(self.interval / 2 - (time() - start_time))
+			self.transport.poll_until(self.step() - self.clock_correction, self.phase_ready)
+
+	def run_until(self, until):
+		# Run rounds (receiving peer messages while waiting on phase deadlines)
+		# until self.time() reaches until
+		while True:
+			deadline = self.step()
+			if deadline >= until:
+				self.transport.poll_until(until - self.clock_correction, self.phase_ready)
+				if self.time() >= until:
+					return
+			else:
+				self.transport.poll_until(deadline - self.clock_correction, self.phase_ready)
+
+	def step(self):
+		# Runs every phase which is due, returning the time() by which step()
+		# needs to be called next
+		while self.time() >= self.deadline or self.phase_ready():
+			self.phase()
+		return self.deadline
+
+	def phase_ready(self):
+		# True if the current phase can run before its deadline
+		return self.ready != None and self.ready()
+
+	def _set_phase(self, phase, deadline, ready=None):
+		self.phase = phase
+		self.deadline = deadline
+		self.ready = ready
+
+	def _next_round_start(self):
+		now = self.time()
+		next_start = now + self.interval - now % self.interval
+		# If our clock correction just went backwards, that could be the start
+		# of a round we have already run
+		return max(next_start, (self.round_id + 1) * self.interval)
+
+	def _end_round(self):
+		# This round's heartbeats are in by now; adjust our clock between
+		# rounds rather than under a running one
+		self._update_clock()
+		next_start = self._next_round_start()
+		if self.pipeline and self._master_for(int(next_start) / self.interval).isSelf:
+			# Prepare as soon as the previous round has completed, so we never
+			# propose what it is still sending
+			self.next_start = next_start
+			self._set_phase(self._phase_prepare_master_msg, next_start, self._completions_done)
+		else:
+			self._set_phase(self._phase_start_round, next_start)
+
+	def _update_clock(self):
+		for node in self.nodes:
+			if node.isSelf:
+				continue
+			while len(node.heartbeats) != 0:
+				msg = node.heartbeats.popleft()
+				try:
+					heartbeat = json.loads(msg[2])
+					sent = float(heartbeat["sent"])
+					echo = heartbeat["echo"].get(self.host)
+					node.last_heartbeat = (sent, msg[3])
+					if echo != None:
+						# As NTP: t1 we sent, t2 they received, t3 they sent, t4 we received
+						(t1, t2, t3, t4) = (float(echo[0]), float(echo[1]), sent, msg[3])
+						node.clock.add_sample(((t2 - t1) + (t3 - t4)) / 2, (t4 - t1) - (t3 - t2), self.round_id)
+				except Exception as e:
+					print("Got bad heartbeat from %s" % node.host)
+					metrics.inc("consensus.bad_messages")
+		if not self.clock_sync:
+			return
+		offsets = [0.0] + [offset for offset in self._peer_clock_offsets().values() if offset != None]
+		offsets.sort()
+		self.clock_correction = offsets[len(offsets) / 2]
+		if len(offsets) % 2 == 0:
+			self.clock_correction = (offsets[len(offsets) / 2 - 1] + offsets[len(offsets) / 2]) / 2
+
+	def _peer_clock_offsets(self):
+		# host -> offset, or None for peers we have no recent samples from (so
+		# that dead nodes cannot drag our clock around). Not _is_live: if our
+		# clock is far enough ahead, every peer looks down until it is fixed.
+		offsets = {}
+		for node in self.nodes:
+			if not node.isSelf:
+				offsets[node.host] = node.clock.offset(self.round_id - CLOCK_SAMPLE_ROUNDS)
+		return offsets
 
+	def _send_heartbeat(self):
+		echo = {}
+		for node in self.nodes:
+			if not node.isSelf and node.last_heartbeat != None:
+				echo[node.host] = node.last_heartbeat
+		heartbeat = json.dumps({"sent": self.transport.time(), "echo": echo})
+		self.transport.send_message(MSG_HEARTBEAT, self.round_id, self.master.host, heartbeat)
+
+	def _is_live(self, node, round_id):
+		if node.isSelf or self.liveness_slots == None or node.last_seen_round == None:
+			return True
+		return round_id - node.last_seen_round <= self.liveness_slots
+
+	def _master_for(self, round_id):
+		# The round's slot in the rotation, or if that node has gone quiet the
+		# first live node after it. Everyone hears the same heartbeats, so
+		# everyone who is up picks the same master.
+		step = round_id % len(self.nodes)
+		for i in range(len(self.nodes)):
+			node = self.nodes[(step + i) % len(self.nodes)]
+			if self._is_live(node, round_id):
+				return node
+
+	def _fail_round(self, reason):
+		self._round_failed()
+		self.tracer.finish(self.trace, reason)
+		self._end_round()
+
+	def _phase_start_round(self):
+		self.round_start = int(self.time())
+		self.round_id = self.round_start / self.interval
+		self.master = self._master_for(self.round_id)
+		if self.master != self.nodes[self.round_id % len(self.nodes)]:
+			metrics.inc("consensus.skipped_masters")
+		metrics.inc("consensus.rounds")
+		self.trace = self.tracer.begin(self.round_id, self.round_start, self.master.host, self.master.isSelf)
+
+		# Leftovers from previous rounds are dropped by round id, as they
+		# arrive; with pipelining the master's message may already be here
+		for node in self.nodes:
+			node.start_round(self.round_id)
+		if self.heartbeats:
+			self._send_heartbeat()
+
+		prepared = self.prepared
+		self.prepared = None
+		if self.master.isSelf and prepared != None and prepared[0] == self.round_id:
+			print("Starting master round (as %s) with prepared message" % self.master.host)
+			self.trace.durations["gen_master_msg"] = prepared[2]
+			self._send_master_msg(prepared[1])
+		elif self.master.isSelf:
+			print("Starting master round (as %s)" % self.master.host)
+			self._set_phase(self._phase_gen_master_msg, self.round_start + self.interval / 10)
+		else:
+			print("Starting round with master %s" % self.master.host)
+			self._set_phase(self._phase_recv_master_msg, self.round_start + self.interval / 4, lambda: self.master.has_message(MSG_MASTER, self.round_id, self.master.host))
+
+	def _phase_prepare_master_msg(self):
+		# Pipelined: we are the next master and the previous round has
+		# completed, so generate our message now. If it is still completing at
+		# our round start, leave it to _phase_gen_master_msg.
+		next_start = self.next_start
+		if not self._completions_done():
+			self._set_phase(self._phase_start_round, next_start)
+			return
+		self.round_id = int(next_start) / self.interval
+		started = self.time()
+		msg = self._gen_master_msg()
+		if msg != None:
+			self.prepared = (self.round_id, msg, self.time() - started)
+		else:
+			print("gen_master_msg threw or returned None preparing round %d" % self.round_id)
+		self._set_phase(self._phase_start_round, next_start)
+
+	def _phase_gen_master_msg(self):
+		if self.pipeline and not self._wait_for_completions(self.round_start + self.interval / 5):
+			print("Previous round still completing: Skipping round!")
+			self._fail_round("previous round still completing")
+			return
+		started = self.time()
+		msg = self._gen_master_msg()
+		self.trace.durations["gen_master_msg"] = self.time() - started
+		if msg == None:
+			print("gen_master_msg threw or returned None")
+			self._fail_round("gen_master_msg failed")
+			return
+		if self.time() - self.round_start > self.interval / 5:
+			print("gen_master_msg took longer than interval/5: Skipping round!")
+			self._fail_round("gen_master_msg too slow")
+			return
+		self._send_master_msg(msg)
+
+	def _send_master_msg(self, msg):
+		self.transport.send_message(MSG_MASTER, self.round_id, self.master.host, self.encode_message(msg))
+		self.trace.event("sent_master_msg")
+		self._wait_for_responses()
+
+	def _phase_recv_master_msg(self):
+		msg = self.master.read_message(MSG_MASTER, self.round_id, self.master.host)
+		if msg == None:
+			print("Missed message from master")
+			metrics.inc("consensus.missed_master")
+			self.trace.missed.append(self.master.host)
+			self._fail_round("missed master")
+			return
+		self.trace.arrivals[self.master.host] = msg[3] + self.clock_correction - self.round_start
+
+		started = self.time()
+		broadcast_msg = self._recv_master_msg(msg[2])
+		self.trace.durations["recv_master_msg"] = self.time() - started
+		if broadcast_msg == None:
+			print("recv_master_msg threw or returned None")
+			self._fail_round("recv_master_msg failed")
+			return
+		if self.time() - self.round_start > self.interval / 2:
+			print("recv_master_msg took longer than interval/4: Skipping round!")
+			self._fail_round("recv_master_msg too slow")
+			return
+		self.transport.send_message(MSG_RESPONSE, self.round_id, self.master.host, self.encode_message(broadcast_msg))
+		self.trace.event("sent_response")
+		self._wait_for_responses()
+
+	def _wait_for_responses(self):
+		# Everyone but us, the master and anyone we think is down responds to
+		# the master's message
+		self.responders = [node for node in self.nodes if not node.isSelf and (self.master.isSelf or node != self.master) and self._is_live(node, self.round_id)]
+		needed = len(self.responders)
+		if self.quorum != None:
+			needed = min(self.quorum, needed)
+		def responses_in():
+			return len([node for node in self.responders if node.has_message(MSG_RESPONSE, self.round_id, self.master.host)]) >= needed
+		self._set_phase(self._phase_round_done, self.round_start + self.interval / 2, responses_in)
+
+	def _phase_round_done(self):
+		if self.time() < self.deadline:
+			metrics.inc("consensus.early_round_done")
+		msgs = []
+		for node in self.nodes:
+			msg = node.read_message(MSG_RESPONSE, self.round_id, self.master.host)
+			if msg == None:
+				if node in self.responders:
+					self.trace.missed.append(node.host)
+				continue
+			self.trace.arrivals[node.host] = msg[3] + self.clock_correction - self.round_start
+			try:
+				msgs.append((node.host, self.decode_message(msg[2])))
+			except Exception as e:
+				print("Got undecodable response from %s" % node.host)
+				metrics.inc("consensus.bad_messages")
+
+		metrics.set_gauge("consensus.last_round_peer_messages", len(msgs))
+		if self.pipeline:
+			self.completing_cond.acquire()
+			self.completing += 1
+			self.completing_cond.release()
+			self.completions.put((self.round_id, msgs, self.round_start, self.trace))
+		else:
+			self._complete_round(self.round_id, msgs, self.round_start, self.trace)
+		self._end_round()
+
+	def _complete_round(self, round_id, msgs, round_start, trace):
+		started = self.time()
+		self._round_done(round_id, msgs)
+		trace.durations["round_done"] = self.time() - started
+		outcome = "done"
+		if self.time() > round_start + self.interval:
+			if self.pipeline:
+				print("round_done finished after the next round started")
 			else:
-				print("Starting round with master %s" % self.nodes[step].host)
-				sleep(self.interval / 4)
-				msg = self.nodes[step].read_message()
-
-				if msg == None:
-					print("Missed message from master")
-					self._round_failed()
-					continue
-
-				broadcast_msg = self._recv_master_msg(msg)
-				if broadcast_msg == None:
-					print("recv_master_msg threw or returned None")
-					self._round_failed()
-					continue
-				if time() - start_time > self.interval / 2:
-					print("recv_master_msg took longer than interval/4: Skipping round!")
-					self._round_failed()
-					continue
-				self.publisher.send_message(broadcast_msg)
-
-				sleep(self.interval / 2 - (time() - start_time))
-
-			msgs = []
-			for node in self.nodes:
-				msg = node.read_message()
-				if msg != None:
-					msgs.append((node.host, msg))
-
-			self._round_done(msgs)
-			if time() > start_time + self.interval:
 				print("round_done took longer than interval/2: We skipped a round!")
+				metrics.inc("consensus.skipped_rounds")
+			outcome = "done late"
+		self.tracer.finish(trace, outcome)
 
 	def _gen_master_msg(self):
 		try:
-			return self.gen_master_msg()
+			with metrics.timed("phase.gen_master_msg"):
+				return self.gen_master_msg()
 		except Exception as e:
 			if isinstance(e, JSONRPCException):
 				print(e.error)
@@ -137,7 +620,8 @@ class RotatingConsensus:
 
 	def _recv_master_msg(self, msg):
 		try:
-			return self.recv_master_msg(msg)
+			with metrics.timed("phase.recv_master_msg"):
+				return self.recv_master_msg(self.decode_message(msg))
 		except Exception as e:
 			if isinstance(e, JSONRPCException):
 				print(e.error)
@@ -145,9 +629,11 @@ class RotatingConsensus:
 			print(traceback.format_exc())
 			return None
 
-	def _round_done(self, peer_messages):
+	def _round_done(self, round_id, peer_messages):
+		self.done_round_id = round_id
 		try:
-			self.round_done(peer_messages)
+			with metrics.timed("phase.round_done"):
+				self.round_done(peer_messages)
 		except Exception as e:
 			if isinstance(e, JSONRPCException):
 				print(e.error)
@@ -155,6 +641,7 @@ class RotatingConsensus:
 			print(traceback.format_exc())
 
 	def _round_failed(self):
+		metrics.inc("consensus.rounds_failed")
 		try:
 			self.round_failed()
 		except Exception as e:
@@ -165,6 +652,14 @@ class RotatingConsensus:
 
 	#OVERRIDE THESE:
 
+	# Convert the messages gen_master_msg/recv_master_msg return to the bytes
+	# sent on the wire, and back, eg to send hex as raw binary
+	def encode_message(self, msg):
+		return msg.encode("ascii", "strict")
+
+	def decode_message(self, payload):
+		return payload
+
 	def gen_master_msg(self):
 		return "MASTER INITIAL BROADCAST"
 
@@ -0,0 +1,108 @@
+#!/usr/bin/env python2
+
+# Per-round trace records for RotatingConsensus: when each phase happened,
+# how long each callback took, when each peer's message arrived and who we
+# never heard from. Kept in a ring buffer (and optionally appended to a
+# rolling JSON-lines file), with percentile summaries over the ring.
+
+import json, os, threading
+from time import time
+from collections import deque
+
+class RoundTrace:
+	def __init__(self, round_id, start, master, is_master, clock=time):
+		self.clock = clock
+		self.round_id = round_id
+		self.start = start
+		self.master = master
+		self.is_master = is_master
+		# [(seconds since start, event name), ...]
+		self.events = []
+		# callback name -> seconds it took
+		self.durations = {}
+		# host -> seconds since start when its message arrived
+		self.arrivals = {}
+		self.missed = []
+		self.outcome = None
+
+	def event(self, name):
+		self.events.append((self.clock() - self.start, name))
+
+	def to_dict(self):
+		return {"round_id": self.round_id, "start": self.start, "master": self.master, "is_master": self.is_master, "events": self.events, "durations": self.durations, "arrivals": self.arrivals, "missed": self.missed, "outcome": self.outcome}
+
+
+def percentiles(samples):
+	if len(samples) == 0:
+		return None
+	samples = sorted(samples)
+	def at(p):
+		return samples[int(round(p * (len(samples) - 1)))]
+	return {"count": len(samples), "p50": at(0.5), "p90": at(0.9), "p99": at(0.99), "max": samples[-1]}
+
+
+class RoundTracer:
+	# keep=None keeps every round; clock is what time() the traced rounds use
+	def __init__(self, path=None, keep=1000, max_file_size=10 * 1024 * 1024, clock=time):
+		self.clock = clock
+		self.rounds = deque(maxlen=keep)
+		self.lock = threading.Lock()
+		self.path = path
+		self.max_file_size = max_file_size
+
+	def begin(self, round_id, start, master, is_master):
+		return RoundTrace(round_id, start, master, is_master, self.clock)
+
+	def finish(self, trace, outcome):
+		trace.outcome = outcome
+		trace.event("end")
+		self.lock.acquire()
+		try:
+			self.rounds.append(trace)
+			if self.path != None:
+				self._write(json.dumps(trace.to_dict(), sort_keys=True) + "\n")
+		finally:
+			self.lock.release()
+
+	def _write(self, line):
+		# Once the file is too big it becomes path.1, replacing the one before
+		if os.path.exists(self.path) and os.path.getsize(self.path) + len(line) > self.max_file_size:
+			os.rename(self.path, self.path + ".1")
+		with open(self.path, "a") as f:
+			f.write(line)
+
+	def recent(self, count=10):
+		self.lock.acquire()
+		try:
+			return [trace.to_dict() for trace in list(self.rounds)[-count:]]
+		finally:
+			self.lock.release()
+
+	def summary(self):
+		# Percentiles over the rounds in the ring: callback durations, when
+		# each phase event happened, and per-peer arrival times and misses
+		self.lock.acquire()
+		try:
+			rounds = list(self.rounds)
+		finally:
+			self.lock.release()
+
+		outcomes = {}
+		durations = {}
+		events = {}
+		peers = {}
+		for trace in rounds:
+			outcomes[trace.outcome] = outcomes.get(trace.outcome, 0) + 1
+			for name in trace.durations:
+				durations.setdefault(name, []).append(trace.durations[name])
+			for (offset, name) in trace.events:
+				events.setdefault(name, []).append(offset)
+			for host in trace.arrivals:
+				peers.setdefault(host, {"arrivals": [], "missed": 0})["arrivals"].append(trace.arrivals[host])
+			for host in trace.missed:
+				peers.setdefault(host, {"arrivals": [], "missed": 0})["missed"] += 1
+
+		return {"rounds": len(rounds), "outcomes": outcomes,
+			"durations": dict([(name, percentiles(durations[name])) for name in durations]),
+			"events": dict([(name, percentiles(events[name])) for name in events]),
+			"peers": dict([(host, {"arrival": percentiles(peers[host]["arrivals"]), "missed": peers[host]["missed"]}) for host in peers])}
@@ -0,0 +1,150 @@
+#!/usr/bin/env python2
+
+# Unit tests for RotatingConsensus, run over consensus_sim's in-memory
+# transport. Run with: python test_rotating_consensus.py
+#
+# Needs the same python-bitcoinrpc and zmq imports as rotating_consensus itself.
+
+import unittest, zlib
+from rotating_consensus import RotatingConsensus, MSG_HEARTBEAT, CLOCK_SAMPLE_ROUNDS, MSG_MASTER, MSG_FLAG_ZLIB, MAX_MESSAGE_SIZE, build_message, parse_message
+from consensus_sim import SimNetwork, Simulator
+from bench_withdrawwatch import Quiet
+
+HOSTS = ["A", "B", "C", "D"]
+INTERVAL = 10
+
+class QuietNode(RotatingConsensus):
+	def gen_master_msg(self):
+		return "proposal"
+
+	def recv_master_msg(self, msg):
+		return "signature"
+
+	def round_done(self, peer_messages):
+		return
+
+def make_nodes(hosts=HOSTS, **kwargs):
+	network = SimNetwork()
+	nodes = {}
+	for host in hosts:
+		transport = network.transport(host, [peer for peer in hosts if peer != host])
+		nodes[host] = QuietNode([], host, None, INTERVAL, None, start_thread=False, transport=transport, **kwargs)
+	return (network, nodes)
+
+def peer(node, host):
+	return [n for n in node.nodes if n.host == host][0]
+
+def heartbeat(round_id, master):
+	return (round_id, MSG_HEARTBEAT, "", 0.0, master)
+
+
+class MessageTest(unittest.TestCase):
+	def test_compressed_round_trip(self):
+		payload = "proposal " * 1000
+		frames = build_message(MSG_MASTER, 7, "A", payload, compress=True)
+		self.assertTrue(len(frames[3]) < len(payload))
+		self.assertEqual(parse_message(frames, 1.0), (7, MSG_MASTER, payload, 1.0, "A"))
+
+	def test_decompressing_past_the_limit_is_rejected(self):
+		frames = build_message(MSG_MASTER, 7, "A", "", compress=True)
+		frames[1] = frames[1][:2] + chr(MSG_FLAG_ZLIB) + frames[1][3:]
+		frames[3] = zlib.compress("\0" * (MAX_MESSAGE_SIZE + 1))
+		self.assertEqual(parse_message(frames, 1.0), None)
+		frames[3] = zlib.compress("\0" * MAX_MESSAGE_SIZE)
+		self.assertEqual(len(parse_message(frames, 1.0)[2]), MAX_MESSAGE_SIZE)
+
+class PeerTest(unittest.TestCase):
+	def test_messages_for_rounds_after_the_next_are_dropped(self):
+		(network, nodes) = make_nodes()
+		d = peer(nodes["A"], "D")
+		d.start_round(100)
+		d.receive((101, MSG_MASTER, "early", 0.0, "D"))
+		d.receive((150, MSG_MASTER, "from the future", 0.0, "D"))
+		d.receive(heartbeat(150, "D"))
+		self.assertEqual([msg[2] for msg in d.inbox], ["early"])
+		self.assertEqual(d.last_seen_round, 101)
+		# but the heartbeat is still there for the clock
+		self.assertEqual(len(d.heartbeats), 1)
+
+class LivenessTest(unittest.TestCase):
+	def test_heartbeats_either_side_of_a_round_boundary(self):
+		# D's last heartbeat, for round 100, reaches A just before A starts
+		# round 100 and B just after. Both must agree on D's liveness (and so
+		# on every master) at the liveness_slots boundary and beyond.
+		(network, nodes) = make_nodes(liveness_slots=3)
+		(a, b) = (nodes["A"], nodes["B"])
+		for node in (a, b):
+			for n in node.nodes:
+				n.start_round(99)
+		peer(a, "D").receive(heartbeat(100, "A"))
+		for node in (a, b):
+			for n in node.nodes:
+				n.start_round(100)
+		peer(b, "D").receive(heartbeat(100, "A"))
+
+		self.assertEqual(peer(a, "D").last_seen_round, peer(b, "D").last_seen_round)
+		for round_id in range(100, 110):
+			# Everyone but D is still up
+			for node in (a, b):
+				for n in node.nodes:
+					n.start_round(round_id)
+				for host in ("A", "B", "C"):
+					if host != node.host:
+						peer(node, host).receive(heartbeat(round_id, "A"))
+			self.assertEqual(a._master_for(round_id).host, b._master_for(round_id).host)
+		# D's slots are 103 and 107: still live 3 rounds on, skipped after
+		self.assertEqual(a._master_for(103).host, "D")
+		self.assertEqual(a._master_for(107).host, "A")
+
+	def test_rounds_do_not_wait_for_offline_peers(self):
+		(network, nodes) = make_nodes(liveness_slots=2)
+		network.transports["D"].offline = True
+		simulator = Simulator(network)
+		for host in HOSTS:
+			simulator.add(nodes[host])
+		with Quiet():
+			simulator.run(network.now + 20 * INTERVAL)
+
+		# Once D has been missing for liveness_slots rounds, every round A
+		# takes part in finishes as soon as B and C have responded
+		traces = list(nodes["A"].tracer.rounds)[5:]
+		self.assertTrue(len(traces) > 5)
+		for trace in traces:
+			self.assertTrue(trace.outcome.startswith("done"))
+			self.assertTrue([offset for (offset, name) in trace.events if name == "end"][0] < INTERVAL / 4)
+
+class ClockSyncTest(unittest.TestCase):
+	def test_stale_offsets_do_not_count(self):
+		(network, nodes) = make_nodes(clock_sync=True)
+		a = nodes["A"]
+		a.round_id = 100
+		# B and D were 30 seconds ahead when last heard from, long ago
+		peer(a, "B").clock.add_sample(30.0, 0.1, 50)
+		peer(a, "D").clock.add_sample(30.0, 0.1, 50)
+		peer(a, "C").clock.add_sample(1.0, 0.1, 100)
+		a._update_clock()
+		self.assertEqual(a.clock_correction, 0.5)
+		self.assertEqual(a._peer_clock_offsets(), {"B": None, "C": 1.0, "D": None})
+	def test_a_clock_far_off_the_rest_is_corrected(self):
+		# More than CLOCK_SAMPLE_ROUNDS rounds ahead, so every heartbeat A
+		# gets is for a round it thinks is long past
+		(network, nodes) = make_nodes(clock_sync=True, liveness_slots=3)
+		network.transports["A"].skew = 4 * CLOCK_SAMPLE_ROUNDS * INTERVAL
+		simulator = Simulator(network)
+		for host in HOSTS:
+			simulator.add(nodes[host])
+		with Quiet():
+			simulator.run(network.now + 30 * INTERVAL)
+		self.assertTrue(abs(nodes["A"].time() - nodes["B"].time()) < 1)
+		traces = list(nodes["A"].tracer.rounds)[-10:]
+		self.assertTrue(len([trace for trace in traces if trace.outcome.startswith("done")]) >= 9)
+
+	def test_correction_going_backwards_never_repeats_a_round(self):
+		(network, nodes) = make_nodes(clock_sync=True)
+		a = nodes["A"]
+		# We just ran the round after the one our clock now says it is
+		a.round_id = int(a.time()) / INTERVAL + 1
+		self.assertTrue(a._next_round_start() >= (a.round_id + 1) * INTERVAL)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python2
+
+# Unit tests for withdrawwatch's withdraw transaction building, against an
+# in-process stand-in for bitcoind. Run with: python test_withdrawwatch.py
+#
+# Needs the same python-bitcoinrpc and zmq imports as withdrawwatch itself.
+
+import os, sys, tempfile, shutil, unittest, pickle
+
+# withdrawwatch keeps its journals in the working directory
+workdir = tempfile.mkdtemp(prefix="test_withdrawwatch")
+cwd = os.getcwd()
+os.chdir(workdir)
+try:
+	import withdrawwatch as ww
+finally:
+	os.chdir(cwd)
+	shutil.rmtree(workdir)
+
+from withdraw_records import PendingWithdraw, Utxo
+from consensus_sim import SimNetwork
+from bench_withdrawwatch import BenchBitcoin, BenchTools, Quiet, ser_tx, deser_tx
+
+class UnspentBitcoin:
+	# Every output is unspent
+	def gettxout(self, txid, vout, include_mempool=True):
+		return {"value": 1}
+
+def txid(n):
+	return ("%064x" % n).decode("hex")
+
+def withdraw(n, spent_from):
+	return PendingWithdraw("%064x" % n, n, "00" * 20, 100000, set([frozenset(inputs) for inputs in spent_from]))
+
+
+class RetryPackingTest(unittest.TestCase):
+	def setUp(self):
+		self.saved = (ww.settings.withdraw_tx_max_outputs, ww.settings.withdraw_txs_per_round)
+		ww.settings.withdraw_tx_max_outputs = 10
+		ww.settings.withdraw_txs_per_round = 4
+		ww.bitcoin.factory = UnspentBitcoin
+		ww.bitcoin.discard_all()
+
+	def tearDown(self):
+		(ww.settings.withdraw_tx_max_outputs, ww.settings.withdraw_txs_per_round) = self.saved
+
+	def check_batches(self, batches, pending):
+		inputs_seen = set()
+		for (outputs, inputs_required) in batches:
+			self.assertTrue(len(outputs) <= ww.settings.withdraw_tx_max_outputs)
+			# Every earlier attempt at each output is double-spent
+			for output in outputs:
+				for input_set in output.spent_from:
+					self.assertFalse(input_set.isdisjoint(inputs_required))
+			# and no two retries double-spend each other
+			self.assertTrue(inputs_seen.isdisjoint(inputs_required))
+			inputs_seen.update(inputs_required)
+		retried = [output.txid_concat for (outputs, inputs_required) in batches for output in outputs]
+		self.assertEqual(sorted(retried), sorted([output.txid_concat for output in pending]))
+
+	def test_retry_set_larger_than_one_transaction(self):
+		# Three earlier transactions of 10, 10 and 5 withdraws
+		pending = [withdraw(i, [[(txid(1), 0)]]) for i in range(10)]
+		pending += [withdraw(i, [[(txid(2), 0), (txid(2), 1)]]) for i in range(10, 20)]
+		pending += [withdraw(i, [[(txid(3), 0)]]) for i in range(20, 25)]
+		batches = ww.select_retry_withdraws(pending)
+		self.assertEqual(len(batches), 3)
+		self.check_batches(batches, pending)
+
+	def test_retries_which_already_share_inputs_stay_together(self):
+		# Withdraws 0-4 were tried twice, once alongside 5-9
+		pending = [withdraw(i, [[(txid(1), 0)], [(txid(2), 0)]]) for i in range(5)]
+		pending += [withdraw(i, [[(txid(2), 0)]]) for i in range(5, 10)]
+		pending += [withdraw(i, [[(txid(3), i)]]) for i in range(10, 18)]
+		batches = ww.select_retry_withdraws(pending)
+		self.assertEqual(len(batches), 2)
+		self.check_batches(batches, pending)
+		self.assertEqual(len(batches[0][0]), 10)
+
+	def test_retries_limited_per_round(self):
+		pending = [withdraw(i, [[(txid(i), 0)]]) for i in range(100)]
+		batches = ww.select_retry_withdraws(pending)
+		self.assertEqual(len(batches), ww.settings.withdraw_txs_per_round)
+		for (outputs, inputs_required) in batches:
+			self.assertEqual(len(outputs), 10)
+
+class TipSidechain:
+	def getblockcount(self):
+		return 100
+
+class SelfFundTest(unittest.TestCase):
+	def setUp(self):
+		self.saved = (ww.run_bitcoin_tx, ww.utxos, ww.outputs_pending, ww.donated_funds)
+		ww.run_bitcoin_tx = BenchTools(ww.settings).bitcoin_tx
+		ww.utxos = {}
+		ww.outputs_pending = {}
+		ww.donated_funds = 0
+		ww.bitcoin.factory = lambda: BenchBitcoin(ww.settings)
+		ww.bitcoin.discard_all()
+		ww.sidechain.factory = TipSidechain
+		ww.sidechain.discard_all()
+
+	def tearDown(self):
+		(ww.run_bitcoin_tx, ww.utxos, ww.outputs_pending, ww.donated_funds) = self.saved
+
+	def add_utxo(self, n, value, spent_by=None):
+		utxo = Utxo(txid(n), 0, "", ww.settings.redeem_script, "", value)
+		if spent_by != None:
+			utxo.spent_by = frozenset(spent_by)
+		ww.utxos[(txid(n), 0)] = utxo
+
+	def fund(self, value):
+		tx_hex = ser_tx([], [(value, "\xa9\x14" + "\x00" * 20 + "\x87")]).encode("hex")
+		with Quiet():
+			return deser_tx(ww.self_fund_withdraw_tx(tx_hex, 1, value, [], set()).decode("hex"))
+
+	def test_coins_used_by_signed_transactions_are_left_alone(self):
+		# while the withdraw they were used for is still pending
+		ww.outputs_pending["%064x" % 1] = withdraw(1, [[(txid(1), 0)]])
+		self.add_utxo(1, 1000000000, ["%064x" % 1])
+		self.add_utxo(2, 60000000)
+		self.add_utxo(3, 60000000)
+		(inputs, outputs) = self.fund(100000000)
+		self.assertEqual(sorted([inp[0] for inp in inputs]), ["%064x" % 2, "%064x" % 3])
+		del ww.utxos[(txid(3), 0)]
+		self.assertRaises(Exception, self.fund, 100000000)
+
+	def test_coins_from_attempts_which_lost_are_used_again(self):
+		# u1 went into an attempt at withdraw 1, which a retry then completed
+		self.add_utxo(1, 200000000, ["%064x" % 1])
+		(inputs, outputs) = self.fund(100000000)
+		self.assertEqual([inp[0] for inp in inputs], ["%064x" % 1])
+
+	def test_dust_change_goes_to_the_fee(self):
+		for change in (0, ww.DUST_LIMIT):
+			self.add_utxo(1, 100000000 + change)
+			(inputs, outputs) = self.fund(100000000)
+			self.assertEqual([output[0] for output in outputs], [100000000])
+		self.add_utxo(1, 100000000 + ww.DUST_LIMIT + 1)
+		(inputs, outputs) = self.fund(100000000)
+		self.assertEqual([output[0] for output in outputs], [100000000, ww.DUST_LIMIT + 1])
+
+	def test_we_sign_what_we_fund_when_paying_a_fee(self):
+		ww.donated_funds = 100000000
+		output = withdraw(1, [])
+		output.value = 100000000
+		ww.outputs_pending = {output.txid_concat: output}
+		# The fee for one input and one withdraw, with change
+		self.add_utxo(1, 200000000)
+		with Quiet():
+			tx_hex = ww.self_fund_withdraw_tx(ww.create_withdraw_tx([output], []), 1, output.value, [], set())
+		fee = 100000000 - deser_tx(tx_hex.decode("hex"))[1][1][0]
+		for change in (0, 100, ww.DUST_LIMIT - 6, ww.DUST_LIMIT, ww.DUST_LIMIT + 1, 600):
+			ww.donated_funds = 100000000
+			self.add_utxo(1, output.value + fee + change)
+			with Quiet():
+				tx_hex = ww.self_fund_withdraw_tx(ww.create_withdraw_tx([output], []), 1, output.value, [], set())
+				ww._sign_withdraw_tx(tx_hex, [output.txid_concat])
+			self.assertEqual(len(deser_tx(tx_hex.decode("hex"))[1]), 1 if change <= ww.DUST_LIMIT else 2)
+
+class MempoolSidechain:
+	# Serves txs (txid -> decoded tx), like sidechaind failing the whole
+	# batch if any has left the mempool
+	def __init__(self, txs):
+		self.txs = txs
+
+	def getrawtransaction(self, txid, verbose=0):
+		if txid not in self.txs:
+			raise ww.JSONRPCException({"code": -5, "message": "No such mempool or blockchain transaction"})
+		return self.txs[txid]
+
+	def batch_(self, calls):
+		return [getattr(self, call[0])(*call[1:]) for call in calls]
+
+def claim(n, contract):
+	return {"txid": "%064x" % n, "vin": [{"scriptSig": {"asm": "0 0 %s" % contract}}], "vout": [
+		{"value": 0, "scriptPubKey": {"type": "withdrawout", "asm": " ".join(["0", "0", "%064x" % n, "0"] + ["0"] * 12)}}]}
+
+class MempoolWatchTest(unittest.TestCase):
+	def setUp(self):
+		self.saved = (ww.run_contracthashtool, ww.settings.self_funded)
+		ww.run_contracthashtool = BenchTools(ww.settings).contracthashtool
+		# Nothing to import into a wallet
+		ww.settings.self_funded = True
+		# and no bitcoin parent can be found
+		ww.bitcoin.factory = lambda: MempoolSidechain({})
+		ww.bitcoin.discard_all()
+
+	def tearDown(self):
+		(ww.run_contracthashtool, ww.settings.self_funded) = self.saved
+
+	def test_bad_claims_do_not_stop_the_rest(self):
+		bad = claim(1, "%040x" % 1)
+		bad["vin"] = []
+		good = claim(2, "%040x" % 2)
+		with Quiet():
+			ww.precompute_pegin_claims([bad, good])
+		self.assertTrue("%040x" % 2 in ww.pegin_contracts)
+
+	def test_transactions_leaving_the_mempool_are_skipped(self):
+		ww.sidechain.factory = lambda: MempoolSidechain({"%064x" % 2: claim(2, "%040x" % 2)})
+		ww.sidechain.discard_all()
+		txs = ww.fetch_sidechain_mempool_txs(["%064x" % 1, "%064x" % 2])
+		self.assertEqual([tx["txid"] for tx in txs], ["%064x" % 2])
+
+def warming_up(height):
+	raise ww.JSONRPCException({"code": -28, "message": "Loading block index..."})
+
+class SyncWorkerTest(unittest.TestCase):
+	def test_worker_errors_survive_the_trip_back(self):
+		try:
+			ww.extract_in_worker((warming_up, 5))
+			self.fail("no exception")
+		except Exception as e:
+			error = pickle.loads(pickle.dumps(e))
+		self.assertTrue("-28" in str(error))
+
+class ControllerTest(unittest.TestCase):
+	def test_round_state_is_per_controller(self):
+		network = SimNetwork()
+		(a, b) = [ww.WatchPeerController([], host, None, 10, None, start_thread=False, transport=network.transport(host, [])) for host in ("A", "B")]
+		a.round_local_txs[1] = ["signed tx"]
+		self.assertEqual(b.round_local_txs, {})
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python2
+
+# Compact record types for withdrawwatch's state maps.
+# Bitcoin txids are kept as 32-byte binary strings (in the usual big-endian
+# display order, ie txid.decode("hex")), values as integer satoshis, and the
+# scripts and keys which are shared by many UTXOs are interned.
+
+import decimal
+
+COIN = 100000000
+
+EMPTY_SET = frozenset()
+
+def btc_to_satoshi(value):
+	return int(decimal.Decimal(value) * COIN)
+
+def satoshi_to_btc(value):
+	# Formatted for bitcoin-tx arguments and printing
+	if value < 0:
+		return "-" + satoshi_to_btc(-value)
+	return "%d.%08d" % divmod(value, COIN)
+
+def txid_to_bin(txid):
+	return str(txid).decode("hex")
+
+def txid_to_hex(txid):
+	return txid.encode("hex")
+
+def outpoint_to_hex(outpoint):
+	return (txid_to_hex(outpoint[0]), outpoint[1])
+
+def intern_str(s):
+	# JSON-RPC hands us unicode, which intern() refuses
+	return intern(str(s))
+
+
+class Utxo(object):
+	# spent_by is a set of sidechain txid_concats which can be used to look up in outputs_pending
+	# donated_map is a map from input sets to the value taken from donated_funds as a fee
+	# (None until this UTXO is first used in a signed transaction)
+	__slots__ = ("txid", "vout", "script_pubkey", "redeem_script", "private_key", "value", "spent_by", "donated_map")
+
+	def __init__(self, txid, vout, script_pubkey, redeem_script, private_key, value):
+		self.txid = txid
+		self.vout = vout
+		self.script_pubkey = intern_str(script_pubkey)
+		self.redeem_script = intern_str(redeem_script)
+		self.private_key = intern_str(private_key)
+		self.value = value
+		self.spent_by = EMPTY_SET
+		self.donated_map = None
+
+	def redeem_info(self):
+		# Formatted for bitcoin signrawtransaction
+		return {"txid": txid_to_hex(self.txid), "vout": self.vout, "scriptPubKey": self.script_pubkey, "redeemScript": self.redeem_script}
+
+
+class PendingWithdraw(object):
+	# spent_from is a set of frozensets of (bitcoin_txid, bitcoin_vout) inputs used in
+	# every tx which was signed and had this output
+	__slots__ = ("txid_concat", "sidechain_height", "p2sh_hash", "value", "spent_from")
+
+	def __init__(self, txid_concat, sidechain_height, p2sh_hash, value, spent_from):
+		self.txid_concat = txid_concat
+		self.sidechain_height = sidechain_height
+		self.p2sh_hash = intern_str(p2sh_hash)
+		self.value = value
+		self.spent_from = spent_from
+
+	@property
+	def script_gen(self):
+		# p2sh script in asm for bitcoin-tx
+		return "OP_HASH160 0x14%s OP_EQUAL" % self.p2sh_hash
+
+	@property
+	def script_match(self):
+		# p2sh script in hex, as it appears in decoded bitcoin transactions
+		return "a914%s87" % self.p2sh_hash
+
+	def copy(self):
+		return PendingWithdraw(self.txid_concat, self.sidechain_height, self.p2sh_hash, self.value, set(self.spent_from))
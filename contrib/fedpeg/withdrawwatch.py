@@ -1,12 +1,17 @@
 #!/usr/bin/env python2
 
-import sys, os, json, traceback, decimal
+import sys, os, json, traceback, heapq, multiprocessing, hashlib
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../../python-bitcoinrpc"))
 from bitcoinrpc.authproxy import AuthServiceProxy, JSONRPCException
 from rotating_consensus import RotatingConsensus
-from threading import Lock, current_thread
+from threading import Lock, Thread
 from time import sleep
 from constants import FedpegConstants
+from metrics import metrics, start_exporter, TimedLock, TimedProxy
+from workers import ConnectionRegistry, ScannerPool
+from bitcoin_raw import parse_block, p2sh_script_for_address
+from withdraw_records import Utxo, PendingWithdraw, btc_to_satoshi, satoshi_to_btc, txid_to_bin, txid_to_hex, outpoint_to_hex
+from collections import deque, OrderedDict
 
 from httplib import CannotSendRequest
 import socket
@@ -14,9 +19,18 @@ import socket
 settings = FedpegConstants()
 port = 14242
 
-sidechain = [AuthServiceProxy(settings.sidechain_url), AuthServiceProxy(settings.sidechain_url)]
-# We need to do a rescan on bitcoin, so we set a huge timeout
-bitcoin = [AuthServiceProxy(settings.bitcoin_url, timeout=60*10), AuthServiceProxy(settings.bitcoin_url)]
+functionary_p2sh_script = p2sh_script_for_address(settings.redeem_script_address)
+functionary_redeem_script = settings.redeem_script.decode("hex")
+
+def sidechain_connection():
+	return TimedProxy(AuthServiceProxy(settings.sidechain_url), "sidechain")
+
+def bitcoin_connection(**kwargs):
+	return TimedProxy(AuthServiceProxy(settings.bitcoin_url, **kwargs), "bitcoin")
+
+# Each thread gets its own connections, via sidechain.get() and bitcoin.get()
+sidechain = ConnectionRegistry(sidechain_connection, "sidechain")
+bitcoin = ConnectionRegistry(bitcoin_connection, "bitcoin")
 
 spent_from_history = {}
 
@@ -26,30 +40,44 @@ with open('spent_from.log') as f:
 		l = eval(line)
 		if l[0] not in spent_from_history:
 			spent_from_history[l[0]] = set()
-		spent_from_history[l[0]].add(l[1])
+		spent_from_history[l[0]].add(frozenset([(txid_to_bin(x[0]), x[1]) for x in l[1]]))
 
 spent_from_log = os.open("spent_from.log", os.O_CREAT | os.O_WRONLY | os.O_SYNC | os.O_DSYNC | os.O_APPEND)
 
+# Scripts which are in the bitcoin wallet and which a full rescan has covered.
+# Scripts are only journaled here after such a rescan, so anything imported
+# after startup (with rescan=False) gets picked up by the next startup rescan.
+# Delete imported_scripts.log if you point withdrawwatch at a fresh wallet.
+imported_scripts = set()
+
+open('imported_scripts.log', 'a').close()  # Touch file (create if not already present)
+with open('imported_scripts.log') as f:
+	for line in f.readlines():
+		imported_scripts.add(line.strip())
+
+imported_scripts_log = os.open("imported_scripts.log", os.O_CREAT | os.O_WRONLY | os.O_SYNC | os.O_DSYNC | os.O_APPEND)
+imported_scripts_lock = Lock()
+unscanned_scripts = []
+
 def check_reset_connections():
-	global sidechain, bitcoin
 	connections_good = True
 
 	try:
-		sidechain[thread_id()].getblockcount()
+		sidechain.get().getblockcount()
 	except CannotSendRequest as e:
-		sidechain[thread_id()] = AuthServiceProxy(settings.sidechain_url)
+		sidechain.reset()
 		connections_good = False
 	except socket.timeout as e:
-		sidechain[thread_id()] = AuthServiceProxy(settings.sidechain_url)
+		sidechain.reset()
 		connections_good = False
 
 	try:
-		bitcoin[thread_id()].getblockcount()
+		bitcoin.get().getblockcount()
 	except CannotSendRequest as e:
-		bitcoin[thread_id()] = AuthServiceProxy(settings.bitcoin_url)
+		bitcoin.reset()
 		connections_good = False
 	except socket.timeout as e:
-		bitcoin[thread_id()] = AuthServiceProxy(settings.bitcoin_url)
+		bitcoin.reset()
 		connections_good = False
 
 	return connections_good
@@ -59,65 +87,123 @@ def check_reset_connections():
 # This is really for ease of developer headache, though we could change some
 # indexes and allow this
 
-map_lock = Lock()
-# withdraw metadata map: {"txid_concat": sidechain_txid_concat, "sidechain_height": height,
-#                         "script_gen": p2sh_script_in_asm_for_bitcoin-tx, "script_match": p2sh_script_in_hex,
-#                         "value": value, "spent_from": set({frozenset({(bitcoin_txid, bitcoin_vout), ...}), ...})}
-#                         (spent_from is a set of sets of inputs used in every tx which was signed signed and had output)
-# sidechain txid_concat -> withdraw metadata map
+map_lock = TimedLock(Lock(), "map_lock")
+# See withdraw_records.py for the record types. Bitcoin txids in these maps are
+# 32-byte binary strings and all values are integer satoshis.
+# sidechain txid_concat -> PendingWithdraw
 outputs_pending = {}
 # withdraw_target_p2sh_script_hex -> txid_concat (for withdraw_claims_pending use)
 outputs_pending_by_p2sh_hex = {}
-# withdraw_target_p2sh_script_hex -> [withdraw metadata map, ...]
+# withdraw_target_p2sh_script_hex -> deque([PendingWithdraw, ...])
 outputs_waiting = {}
 
-# utxo metadata map: {"redeem_info": redeem_info_for_bitcoin_signrawtransaction, "privateKey": gen_private_key, "value": Decimal(value),
-#                     "spent_by": set(), "donated_map": {frozenset({(bitcoin_txid, bitcoin_vout), ...}): value} }
-# spent_by is a set of sidechain txid_concats which can be used to look up in outputs_pending
-# donated_map is a map from input sets to the value taken from donated_funds as a fee
-# (bitcoin_txid, bitcoin_vout) -> utxo metadata map
+# (bitcoin_txid, bitcoin_vout) -> Utxo
 utxos = {}
 
 #set of sets of txos we need to ensure are spent by fraud proofs
 fraud_check_map = {}
 
+# sidechain height -> value donated in that block, credited to donated_funds
+# once the block is confirmed (so each block is only fetched once)
+pending_donations = {}
+
 donated_funds = 0
 
+# Change at or below this many satoshis is added to the fee instead of being
+# given an output of its own, which would cost more to spend than it is worth
+DUST_LIMIT = 546
+
+# Bumped whenever a confirmed withdraw removes entries from utxos or
+# outputs_pending, which can invalidate transactions we signed earlier
+withdraw_state_version = 0
+
+# (sha256 of unsigned tx, txid_concat tuple) -> (withdraw_state_version, signed tx hex)
+# Protected by map_lock
+SIGNATURE_CACHE_SIZE = 64
+signature_cache = OrderedDict()
+
 manual_check_lock = Lock()
 manual_check_set = set()
 
-main_thread = current_thread()
-def thread_id():
-	if current_thread() == main_thread:
-		return 0
-	return 1
+# Threads which fetch and decode blocks for the chain scans (None scans
+# serially), started by start_scanner_pool()
+scanner_pool = None
+
+# Worker processes for the initial sync (None syncs in this process), forked by
+# start_sync_pool() before any thread is started: a child gets only the forking
+# thread, so any lock another thread held at the time would stay held forever
+sync_pool = None
 
 def check_raise(cond):
 	if not cond:
 		raise Exception("assertion failed")
 
+# All use of the external helper binaries goes through these two, so they can
+# be swapped out (see bench_withdrawwatch.py)
+def run_bitcoin_tx(args):
+	# Returns the transaction hex bitcoin-tx printed
+	cht = os.popen("%s %s %s" % (settings.bitcoin_tx_path, settings.btc_testnet_arg, args))
+	tx_hex = cht.read().split("\n")[0]
+	check_raise(cht.close() == None)
+	return tx_hex
+
+def run_contracthashtool(args):
+	# Returns contracthashtool's output lines
+	cht = os.popen("%s %s %s" % (settings.contracthashtool_path, settings.cht_testnet_arg, args))
+	cht_out = cht.read()
+	check_raise(cht.close() == None)
+	return cht_out.split("\n")
+
 def trigger_bitcoin_rescan():
 	# TODO: Replace with a really random one, instead
-	cht = os.popen("%s %s -c -p %s -a SALT -n %s" % (settings.contracthashtool_path, settings.cht_testnet_arg, settings.functionary_private_key, os.urandom(16).encode("hex")))
-	useless_private_key = cht.read().split("\n")[0 + settings.is_testnet][16:]
-	check_raise(cht.close() == None)
+	useless_private_key = run_contracthashtool("-c -p %s -a SALT -n %s" % (settings.functionary_private_key, os.urandom(16).encode("hex")))[0 + settings.is_testnet][16:]
 	# Trigger a rescan by importing something useless and new
 	sys.stdout.write("Now triggering a full wallet rescan of the bitcoin chain...")
 	sys.stdout.flush()
-	bitcoin[thread_id()].importprivkey(useless_private_key, "", True)
+	# The rescan takes a while, so use a one-off connection with a huge timeout
+	bitcoin_connection(timeout=60*10).importprivkey(useless_private_key, "", True)
 	print("done")
 
+def import_bitcoin_script(script):
+	if settings.self_funded:
+		# Nothing is ever spent through the wallet
+		return
+	imported_scripts_lock.acquire()
+	try:
+		if script in imported_scripts:
+			return
+		bitcoin.get().importaddress(script, "", False, True)
+		imported_scripts.add(script)
+		unscanned_scripts.append(script)
+	finally:
+		imported_scripts_lock.release()
+
+def rescan_imported_scripts():
+	imported_scripts_lock.acquire()
+	try:
+		if len(unscanned_scripts) == 0:
+			print("No new scripts imported into the bitcoin wallet, skipping rescan")
+			return
+		trigger_bitcoin_rescan()
+		for script in unscanned_scripts:
+			os.write(imported_scripts_log, script + "\n")
+		del unscanned_scripts[:]
+	finally:
+		imported_scripts_lock.release()
+
 
 def process_bitcoin_tx_for_utxos(tx, is_donation=False, manual_check=False):
 	global donated_funds
 
 	manual_check_lock.acquire()
-	if not manual_check and tx["txid"] in manual_check_set:
-		manual_check_set.remove(tx["txid"])
-		return
-	elif manual_check:
-		manual_check_set.add(tx["txid"])
-	manual_check_lock.release()
+	try:
+		if not manual_check and tx["txid"] in manual_check_set:
+			manual_check_set.remove(tx["txid"])
+			return
+		elif manual_check:
+			manual_check_set.add(tx["txid"])
+	finally:
+		manual_check_lock.release()
 
 	# Go through the outputs, adding any coins sent to the raw functionary address to utxos
 	for nout, outp in enumerate(tx["vout"]):
@@ -125,64 +211,18 @@ def process_bitcoin_tx_for_utxos(tx, is_donation=False, manual_check=False):
 			txo = tx["vout"][nout]
 			map_lock.acquire()
 
-			print("Got %s UTXO sent to raw functioanry address (change or donation): %s:%d" % ("new" if (tx["txid"], nout) not in utxos else "existing", tx["txid"], nout))
-			utxos[(tx["txid"], nout)] = {"redeem_info": {"txid": tx["txid"], "vout": nout, "scriptPubKey": outp["scriptPubKey"]["hex"], "redeemScript": settings.redeem_script}, "privateKey": settings.functionary_private_key, "value": decimal.Decimal(outp["value"]), "spent_by": set(), "donated_map": {}}
+			txid = txid_to_bin(tx["txid"])
+			print("Got %s UTXO sent to raw functioanry address (change or donation): %s:%d" % ("new" if (txid, nout) not in utxos else "existing", tx["txid"], nout))
+			utxos[(txid, nout)] = Utxo(txid, nout, outp["scriptPubKey"]["hex"], settings.redeem_script, settings.functionary_private_key, btc_to_satoshi(outp["value"]))
 
 			if is_donation:
 				print("Got donation of %s, now possibly paying fees" % str(outp["value"]))
-				donated_funds = donated_funds + outp["value"]
+				donated_funds = donated_funds + btc_to_satoshi(outp["value"])
 
 			map_lock.release()
 
 
-def sign_withdraw_tx(tx_hex, txid_concat_list):
-	global donated_funds
-
-	tx_raw = bitcoin[thread_id()].decoderawtransaction(tx_hex)
-	max_sidechain_height = sidechain[thread_id()].getblockcount() - 6
-
-	check_raise(len(tx_raw["vout"]) == len(txid_concat_list) + 1)
-	check_raise(tx_raw["vout"][-1]["scriptPubKey"]["type"] == "scripthash")
-	check_raise(tx_raw["vout"][-1]["scriptPubKey"]["addresses"][0] == settings.redeem_script_address)
-
-	tx_value = decimal.Decimal(0)
-	privKeys = []
-	redeemScripts = []
-	inputs_set = set()
-	input_size = 0
-	for inp in tx_raw["vin"]:
-		if (inp["txid"], inp["vout"]) not in utxos:
-			# To-functionary UTXOs are only added after sufficient confirmations,
-			# so we may need to find them here.
-			spent_tx = bitcoin[thread_id()].getrawtransaction(inp["txid"], 1)
-			process_bitcoin_tx_for_utxos(spent_tx, manual_check=True)
-
-		check_raise((inp["txid"], inp["vout"]) in utxos)
-		utxo = utxos[(inp["txid"], inp["vout"])]
-		redeemScripts.append(utxo["redeem_info"])
-		privKeys.append(utxo["privateKey"])
-		tx_value = tx_value + decimal.Decimal(utxo["value"])
-
-		inputs_set.add((inp["txid"], inp["vout"]))
-		input_size = input_size + len(inp["scriptSig"]["hex"])/2
-		if len(inp["scriptSig"]["hex"])/2 >= 0xfd:
-			input_size += 2
-
-	txid_concat_set = set()
-	for i, txid_concat in enumerate(txid_concat_list):
-		check_raise(txid_concat in outputs_pending)
-		output = outputs_pending[txid_concat]
-		check_raise(output["sidechain_height"] <= max_sidechain_height)
-
-		tx_vout = tx_raw["vout"][i]
-		check_raise(tx_vout["scriptPubKey"]["hex"] == output["script_match"])
-		check_raise(decimal.Decimal(tx_vout["value"]) == output["value"])
-		tx_value = tx_value - decimal.Decimal(tx_vout["value"])
-		for input_set in output["spent_from"]:
-			check_raise(not inputs_set.isdisjoint(input_set))
-
-		txid_concat_set.add(txid_concat)
-
+def signed_input_script_size():
 	# scriptSig is OP_0 x*(1-byte pushlen + 73-byte max-sized signature) + redeemScript push
 	# if it triggers a long var-int for the scriptlen we have to include that, too
 	RS_push_size = len(settings.redeem_script) / 2
@@ -190,213 +230,630 @@ def sign_withdraw_tx(tx_hex, txid_concat_list):
 	scriptSig_size = 1 + 74 * settings.sigs_required + RS_push_size
 	if scriptSig_size >= 0xfd:
 		scriptSig_size += 2
+	return scriptSig_size
 
-	fee_allowed = len(tx_hex)/2 - input_size + scriptSig_size * len(tx_raw["vin"])
-	fee_allowed = min(fee_allowed, donated_funds * 100000000)
-	fee_paid = tx_value - decimal.Decimal(tx_raw["vout"][-1]["value"])
-	check_raise(fee_paid * 100000000 <= fee_allowed)
-
-	donated_funds = donated_funds - fee_paid
-
-	inputs_set = frozenset(inputs_set)
-
-	for txid_concat in txid_concat_list:
-		output = outputs_pending[txid_concat]
-		if inputs_set not in output["spent_from"]:
-			output["spent_from"].add(inputs_set)
-			os.write(spent_from_log, "['%s', %s]\n" % (txid_concat, repr(inputs_set)))
-
-	old_paid_memory = -1
-	for inp in tx_raw["vin"]:
-		utxo = utxos[(inp["txid"], inp["vout"])]
-		utxo["spent_by"] = utxo["spent_by"] | txid_concat_set
-		old_paid = 0
-		if inputs_set in utxo["donated_map"]:
-			old_paid = utxo["donated_map"][inputs_set]
-			if old_paid_memory == -1:
-				old_paid_memory = old_paid
-			elif old_paid != old_paid_memory:
-				print("Internal data structure inconsistency!")
-				sys.exit(1)
-		utxo["donated_map"][inputs_set] = fee_paid + old_paid
 
-	return bitcoin[thread_id()].signrawtransaction(tx_hex, redeemScripts, privKeys)["hex"]
+def snapshot_pending_withdraws(max_sidechain_height):
+	# Copy out everything gen_master_msg needs so that it can do its RPCs and
+	# bitcoin-tx calls without holding map_lock. sign_withdraw_tx re-validates
+	# the result against the live maps before anything is committed.
+	map_lock.acquire()
+	try:
+		snapshot = []
+		for txid_concat in outputs_pending:
+			output = outputs_pending[txid_concat]
+			if output.sidechain_height > max_sidechain_height:
+				continue
+			snapshot.append(output.copy())
+		return snapshot
+	finally:
+		map_lock.release()
 
 
-class WatchPeerController(RotatingConsensus):
-	round_local_tx_hex = ""
+def sign_withdraw_tx(tx_hex, txid_concat_list):
+	# The same unsigned transaction tends to be proposed round after round. If
+	# nothing it depends on has changed since we signed it, hand back the old
+	# signature rather than re-validating (and re-journaling and re-debiting
+	# donated_funds for) it.
+	cache_key = (hashlib.sha256(str(tx_hex)).digest(), tuple(txid_concat_list))
+	map_lock.acquire()
+	try:
+		cached = signature_cache.get(cache_key)
+		if cached != None and cached[0] == withdraw_state_version:
+			metrics.inc("signature_cache.hits")
+			return cached[1]
+	finally:
+		map_lock.release()
 
-	def gen_master_msg(self):
-		if not check_reset_connections():
-			return None
+	metrics.inc("signature_cache.misses")
+	with metrics.timed("phase.sign_withdraw_tx"):
+		(state_version, signed_tx_hex) = _sign_withdraw_tx(tx_hex, txid_concat_list)
 
-		map_lock.acquire()
-		try:
+	map_lock.acquire()
+	try:
+		signature_cache[cache_key] = (state_version, signed_tx_hex)
+		while len(signature_cache) > SIGNATURE_CACHE_SIZE:
+			signature_cache.popitem(last=False)
+	finally:
+		map_lock.release()
+	return signed_tx_hex
 
-			max_sidechain_height = sidechain[thread_id()].getblockcount() - 8
-			txid_concat_list_untried = []
-			txid_concat_list_retries = []
-			command_untried = '%s %s -create' % (settings.bitcoin_tx_path, settings.btc_testnet_arg)
-			command_retries = command_untried
-			input_sets_retries = set()
-			input_pairs_retries = set()
-			for txid_concat in outputs_pending:
-				output = outputs_pending[txid_concat]
-				if output["sidechain_height"] > max_sidechain_height:
-					continue
-				if len(output["spent_from"]) == 0:
-					command_untried = command_untried + ' outscript=%.16g:"%s"' % (output["value"], output["script_gen"])
-					txid_concat_list_untried.append(txid_concat)
-				elif len(txid_concat_list_untried) == 0:
-					all_still_spendable = True
-					for input_set in output["spent_from"]:
-						for input_pair in input_set:
-							if bitcoin[thread_id()].gettxout(input_pair[0], input_pair[1], True) == None:
-								all_still_spendable = False
-								break
-						if not all_still_spendable:
-							break
-					if all_still_spendable:
-						command_retries = command_retries + ' outscript=%.16g:"%s"' % (output["value"], output["script_gen"])
-						txid_concat_list_retries.append(txid_concat)
-						input_sets_retries = input_sets_retries | output["spent_from"]
-						for input_set in output["spent_from"]:
-							input_pairs_retries = input_pairs_retries | input_set
-
-			if len(txid_concat_list_untried) != 0:
-				txid_concat_list = txid_concat_list_untried
-				command = command_untried
-			elif len(txid_concat_list_retries) != 0:
-				inputs_required = []
-				while len(input_sets_retries) != 0:
-					e = max(input_pairs_retries, key=lambda x: len([i for i in input_sets_retries if x in i]))
-					inputs_required.append(e)
-					input_sets_retries = set([x for x in input_sets_retries if e not in x])
-				for input_pair in inputs_required:
-					command_retries = command_retries + ' in="%s":%d' % (input_pair[0], input_pair[1])
-
-				txid_concat_list = txid_concat_list_retries
-				command = command_retries
-			else:
-				return None
+def _sign_withdraw_tx(tx_hex, txid_concat_list):
+	# Returns (withdraw_state_version the checks were made against, signed tx hex)
+	global donated_funds
 
-			cht = os.popen(command)
-			tx_hex = cht.read().split("\n")[0]
-			check_raise(cht.close() == None)
+	# RPC work first, without map_lock held
+	tx_raw = bitcoin.get().decoderawtransaction(tx_hex)
+	max_sidechain_height = sidechain.get().getblockcount() - 6
 
-			funded_tx = bitcoin[thread_id()].fundrawtransaction(tx_hex, True)
-			tx_raw = bitcoin[thread_id()].decoderawtransaction(funded_tx["hex"])
-			change_value = decimal.Decimal(funded_tx["fee"]) + decimal.Decimal(tx_raw["vout"][funded_tx["changepos"]]["value"])
+	# The withdraw outputs, then change to the functionary address unless it
+	# would have been dust
+	has_change = len(tx_raw["vout"]) == len(txid_concat_list) + 1
+	check_raise(has_change or len(tx_raw["vout"]) == len(txid_concat_list))
+	if has_change:
+		check_raise(tx_raw["vout"][-1]["scriptPubKey"]["type"] == "scripthash")
+		check_raise(tx_raw["vout"][-1]["scriptPubKey"]["addresses"][0] == settings.redeem_script_address)
 
-			cht = os.popen('%s %s %s delout=%d outaddr=%s:%s' % (settings.bitcoin_tx_path, settings.btc_testnet_arg, funded_tx["hex"], funded_tx["changepos"], "0", settings.redeem_script_address))
-			tx_hex = cht.read().split("\n")[0]
-			check_raise(cht.close() == None)
+	map_lock.acquire()
+	try:
+		missing_inputs = [inp["txid"] for inp in tx_raw["vin"] if (txid_to_bin(inp["txid"]), inp["vout"]) not in utxos]
+	finally:
+		map_lock.release()
+	for txid in missing_inputs:
+		# To-functionary UTXOs are only added after sufficient confirmations,
+		# so we may need to find them here.
+		spent_tx = bitcoin.get().getrawtransaction(txid, 1)
+		process_bitcoin_tx_for_utxos(spent_tx, manual_check=True)
 
-			redeem_script_push_size = len(settings.redeem_script)/2
-			if redeem_script_push_size <= 0x4b:
-				redeem_script_push_size += 1
-			elif redeem_script_push_size <= 0xff:
-				redeem_script_push_size += 2
-			else:
-				redeem_script_push_size += 3
+	scriptSig_size = signed_input_script_size()
 
-			input_size = 1 + 74 * settings.sigs_required + redeem_script_push_size
-			if input_size >= 0xfd:
+	# Then validate against, and commit to, the live state in one short step
+	spent_from_log_lines = []
+	map_lock.acquire()
+	try:
+		tx_value = 0
+		privKeys = []
+		redeemScripts = []
+		inputs_list = []
+		input_size = 0
+		for inp in tx_raw["vin"]:
+			txid_pair = (txid_to_bin(inp["txid"]), inp["vout"])
+			check_raise(txid_pair in utxos)
+			utxo = utxos[txid_pair]
+			redeemScripts.append(utxo.redeem_info())
+			privKeys.append(utxo.private_key)
+			tx_value = tx_value + utxo.value
+
+			inputs_list.append(txid_pair)
+			input_size = input_size + len(inp["scriptSig"]["hex"])/2
+			if len(inp["scriptSig"]["hex"])/2 >= 0xfd:
 				input_size += 2
 
-			pay_fee = decimal.Decimal(len(tx_hex)/2 + input_size * len(tx_raw["vin"])) / decimal.Decimal(100000000)
-			pay_fee = min(pay_fee, funded_tx["fee"])
-			if pay_fee > donated_funds:
-				pay_fee = 0
-			print("Paying fee of %s" % str(pay_fee))
-			change_value = change_value - pay_fee
+		inputs_set = frozenset(inputs_list)
+
+		txid_concat_set = set()
+		for i, txid_concat in enumerate(txid_concat_list):
+			check_raise(txid_concat in outputs_pending)
+			output = outputs_pending[txid_concat]
+			check_raise(output.sidechain_height <= max_sidechain_height)
+
+			tx_vout = tx_raw["vout"][i]
+			check_raise(tx_vout["scriptPubKey"]["hex"] == output.script_match)
+			check_raise(btc_to_satoshi(tx_vout["value"]) == output.value)
+			tx_value = tx_value - output.value
+			for input_set in output.spent_from:
+				check_raise(not inputs_set.isdisjoint(input_set))
+
+			txid_concat_set.add(txid_concat)
+
+		fee_allowed = len(tx_hex)/2 - input_size + scriptSig_size * len(tx_raw["vin"])
+		if not has_change:
+			# The fee was worked out with the change output the dust would have
+			# gone to (32 bytes, and maybe 2 more for the output count)
+			fee_allowed = fee_allowed + 32 + (2 if len(tx_raw["vout"]) == 0xfc else 0)
+		fee_allowed = min(fee_allowed, donated_funds)
+		if has_change:
+			fee_paid = tx_value - btc_to_satoshi(tx_raw["vout"][-1]["value"])
+			check_raise(fee_paid <= fee_allowed)
+		else:
+			# Change too small to be worth an output goes to the fee as well
+			fee_paid = tx_value
+			check_raise(fee_paid <= fee_allowed + DUST_LIMIT)
+
+		donated_funds = donated_funds - fee_paid
+
+		for txid_concat in txid_concat_list:
+			output = outputs_pending[txid_concat]
+			if inputs_set not in output.spent_from:
+				output.spent_from.add(inputs_set)
+				spent_from_log_lines.append("['%s', %s]\n" % (txid_concat, repr(frozenset([outpoint_to_hex(x) for x in inputs_set]))))
+
+		old_paid_memory = -1
+		for txid_pair in inputs_list:
+			utxo = utxos[txid_pair]
+			utxo.spent_by = utxo.spent_by | txid_concat_set
+			if utxo.donated_map == None:
+				utxo.donated_map = {}
+			old_paid = 0
+			if inputs_set in utxo.donated_map:
+				old_paid = utxo.donated_map[inputs_set]
+				if old_paid_memory == -1:
+					old_paid_memory = old_paid
+				elif old_paid != old_paid_memory:
+					print("Internal data structure inconsistency!")
+					sys.exit(1)
+			utxo.donated_map[inputs_set] = fee_paid + old_paid
+		state_version = withdraw_state_version
+	finally:
+		map_lock.release()
 
-			cht = os.popen('%s %s %s delout=%d outaddr=%s:%s' % (settings.bitcoin_tx_path, settings.btc_testnet_arg, tx_hex, len(tx_raw["vout"]) - 1, change_value, settings.redeem_script_address))
-			tx_hex = cht.read().split("\n")[0]
-			check_raise(cht.close() == None)
+	# The journal must hit disk before any signature leaves this node
+	for line in spent_from_log_lines:
+		os.write(spent_from_log, line)
 
-			self.round_local_tx_hex = sign_withdraw_tx(tx_hex, txid_concat_list)
+	return (state_version, bitcoin.get().signrawtransaction(tx_hex, redeemScripts, privKeys)["hex"])
 
-			return json.dumps([self.round_local_tx_hex, txid_concat_list])
-		finally:
-			map_lock.release()
 
-	def recv_master_msg(self, msg):
-		msg_decoded = json.loads(msg)
-		map_lock.acquire()
+def self_fund_withdraw_tx(tx_hex, output_count, outputs_value, inputs_required, used_inputs):
+	# Add inputs from our own utxos and a change output to the functionary
+	# address to tx_hex (which has the withdraw outputs and any inputs_required),
+	# in place of bitcoind's fundrawtransaction. Fees are paid the same way as
+	# for wallet-funded transactions: only if donated_funds can cover them.
+	# Inputs in used_inputs (taken by an earlier transaction this round) are
+	# skipped, and the ones we pick are added to it.
+	map_lock.acquire()
+	try:
+		inputs_value = 0
+		for txid_pair in inputs_required:
+			check_raise(txid_pair in utxos)
+			inputs_value = inputs_value + utxos[txid_pair].value
+		# Only coins no signed transaction for a still-pending withdraw has used
+		# (spending those is what inputs_required is for), larger coins first.
+		# spent_by is never pruned, so a coin left over from an attempt which
+		# lost to another transaction is free again once its withdraws are done.
+		required = set(inputs_required)
+		candidates = [(-utxo.value, txid_pair) for txid_pair, utxo in utxos.iteritems()
+			if txid_pair not in required and txid_pair not in used_inputs and utxo.spent_by.isdisjoint(outputs_pending)]
+		fee_allowed = donated_funds
+	finally:
+		map_lock.release()
+	heapq.heapify(candidates)
+
+	# Unsigned inputs are 41 bytes, the change output is 32
+	input_size = signed_input_script_size()
+	selected = []
+	while True:
+		input_count = len(inputs_required) + len(selected)
+		pay_fee = len(tx_hex)/2 + 41 * len(selected) + 32 + input_size * input_count
+		if pay_fee > fee_allowed:
+			pay_fee = 0
+		if input_count != 0 and inputs_value >= outputs_value + pay_fee:
+			break
+		if len(candidates) == 0:
+			raise Exception("Not enough funds in functionary utxos to fund withdraw")
+		candidate = heapq.heappop(candidates)
+		selected.append(candidate[1])
+		inputs_value = inputs_value - candidate[0]
+
+	command = tx_hex
+	for input_pair in selected:
+		command = command + ' in="%s":%d' % (txid_to_hex(input_pair[0]), input_pair[1])
+	tx_hex = run_bitcoin_tx(command + ' outaddr=%s:%s' % ("0", settings.redeem_script_address))
+
+	pay_fee = len(tx_hex)/2 + input_size * (len(inputs_required) + len(selected))
+	check_withdraw_tx_size(pay_fee)
+	used_inputs.update(selected)
+	used_inputs.update(inputs_required)
+	if pay_fee > fee_allowed:
+		pay_fee = 0
+	print("Paying fee of %s" % satoshi_to_btc(pay_fee))
+	change_value = inputs_value - outputs_value - pay_fee
+	check_raise(change_value >= 0)
+
+	if change_value <= DUST_LIMIT:
+		# Not worth an output of its own: leave it to the miners
+		print("Adding change of %s to the fee" % satoshi_to_btc(change_value))
+		return run_bitcoin_tx('%s delout=%d' % (tx_hex, output_count))
+	return run_bitcoin_tx('%s delout=%d outaddr=%s:%s' % (tx_hex, output_count, satoshi_to_btc(change_value), settings.redeem_script_address))
+
+
+def pack_withdraws(groups):
+	# Split groups of outputs into batches of at most withdraw_tx_max_outputs,
+	# one per transaction, oldest (then largest) first. Each group stays in one
+	# batch unless it is too big for any. Half of withdraw_tx_max_size is kept
+	# free for the inputs and their signatures.
+	output_key = lambda output: (output.sidechain_height, -output.value)
+	groups = [sorted(group, key=output_key) for group in groups if len(group) != 0]
+	groups.sort(key=lambda group: output_key(group[0]))
+	# version, in/out counts, locktime and the 32-byte change output
+	empty_size = 10 + 32
+	max_outputs = min(settings.withdraw_tx_max_outputs, (settings.withdraw_tx_max_size / 2 - empty_size) / 32)
+	batches = []
+	batch = []
+	for group in groups:
+		if len(batch) + len(group) > max_outputs and len(batch) != 0:
+			batches.append(batch)
+			batch = []
+		for output in group:
+			if len(batch) == max_outputs:
+				batches.append(batch)
+				batch = []
+			batch.append(output)
+		if len(batches) >= settings.withdraw_txs_per_round:
+			return batches[:settings.withdraw_txs_per_round]
+	if len(batch) != 0:
+		batches.append(batch)
+	return batches[:settings.withdraw_txs_per_round]
+
+def group_retry_withdraws(outputs):
+	# Groups outputs whose earlier attempts share any input: their retries
+	# have to go in the same transaction, or the retries would double-spend
+	# each other
+	parent = range(len(outputs))
+	def find(i):
+		while parent[i] != i:
+			parent[i] = parent[parent[i]]
+			i = parent[i]
+		return i
+	owner = {}
+	for i, output in enumerate(outputs):
+		for input_set in output.spent_from:
+			for input_pair in input_set:
+				if input_pair in owner:
+					parent[find(i)] = find(owner[input_pair])
+				else:
+					owner[input_pair] = i
+	groups = {}
+	for i, output in enumerate(outputs):
+		groups.setdefault(find(i), []).append(output)
+	return groups.values()
+
+def check_withdraw_tx_size(signed_size):
+	if signed_size > settings.withdraw_tx_max_size:
+		raise Exception("Funded withdraw transaction would be %d bytes, over withdraw_tx_max_size" % signed_size)
+
+def create_withdraw_tx(outputs, inputs_required):
+	command = '-create'
+	for output in outputs:
+		command = command + ' outscript=%s:"%s"' % (satoshi_to_btc(output.value), output.script_gen)
+	for input_pair in inputs_required:
+		command = command + ' in="%s":%d' % (txid_to_hex(input_pair[0]), input_pair[1])
+	return run_bitcoin_tx(command)
+
+def wallet_fund_withdraw_tx(tx_hex, locked_inputs):
+	# Fund tx_hex using the bitcoind wallet, moving change to the functionary
+	# address. The inputs used are locked in the wallet and appended to
+	# locked_inputs, so later transactions in the same round do not reuse them.
+	funded_tx = bitcoin.get().fundrawtransaction(tx_hex, True)
+	tx_raw = bitcoin.get().decoderawtransaction(funded_tx["hex"])
+	change_value = btc_to_satoshi(funded_tx["fee"]) + btc_to_satoshi(tx_raw["vout"][funded_tx["changepos"]]["value"])
+
+	inputs = [{"txid": inp["txid"], "vout": inp["vout"]} for inp in tx_raw["vin"]]
+	bitcoin.get().lockunspent(False, inputs)
+	locked_inputs.extend(inputs)
+
+	tx_hex = run_bitcoin_tx('%s delout=%d outaddr=%s:%s' % (funded_tx["hex"], funded_tx["changepos"], "0", settings.redeem_script_address))
+
+	input_size = signed_input_script_size()
+
+	pay_fee = len(tx_hex)/2 + input_size * len(tx_raw["vin"])
+	check_withdraw_tx_size(pay_fee)
+	pay_fee = min(pay_fee, btc_to_satoshi(funded_tx["fee"]))
+	if pay_fee > donated_funds:
+		pay_fee = 0
+	print("Paying fee of %s" % satoshi_to_btc(pay_fee))
+	change_value = change_value - pay_fee
+
+	return run_bitcoin_tx('%s delout=%d outaddr=%s:%s' % (tx_hex, len(tx_raw["vout"]) - 1, satoshi_to_btc(change_value), settings.redeem_script_address))
+
+def select_retry_withdraws(pending_snapshot):
+	# Returns [(outputs, inputs_required), ...], transactions which re-send
+	# every previously-tried withdraw whose earlier inputs are all still
+	# unspent, packed like new withdraws. Each double-spends at least one input
+	# of each earlier attempt of its own withdraws.
+	outputs = []
+	for output in pending_snapshot:
+		all_still_spendable = True
+		for input_set in output.spent_from:
+			for input_pair in input_set:
+				if bitcoin.get().gettxout(txid_to_hex(input_pair[0]), input_pair[1], True) == None:
+					all_still_spendable = False
+					break
+			if not all_still_spendable:
+				break
+		if all_still_spendable:
+			outputs.append(output)
+
+	return [(batch, retry_inputs_required(batch)) for batch in pack_withdraws(group_retry_withdraws(outputs))]
+
+def retry_inputs_required(outputs):
+	# A small set of inputs which conflicts with every earlier attempt at outputs
+	input_sets_retries = set()
+	input_pairs_retries = set()
+	for output in outputs:
+		input_sets_retries = input_sets_retries | output.spent_from
+		for input_set in output.spent_from:
+			input_pairs_retries = input_pairs_retries | input_set
+
+	inputs_required = []
+	while len(input_sets_retries) != 0:
+		e = max(input_pairs_retries, key=lambda x: len([i for i in input_sets_retries if x in i]))
+		inputs_required.append(e)
+		input_sets_retries = set([x for x in input_sets_retries if e not in x])
+	return inputs_required
+
+def fund_and_sign_withdraw_tx(outputs, inputs_required, used_inputs, locked_inputs):
+	# Returns [signed_tx_hex, txid_concat_list] for one withdraw transaction
+	tx_hex = create_withdraw_tx(outputs, inputs_required)
+	if settings.self_funded:
+		tx_hex = self_fund_withdraw_tx(tx_hex, len(outputs), sum([output.value for output in outputs]), inputs_required, used_inputs)
+	else:
+		tx_hex = wallet_fund_withdraw_tx(tx_hex, locked_inputs)
+	txid_concat_list = [output.txid_concat for output in outputs]
+	return [sign_withdraw_tx(tx_hex, txid_concat_list), txid_concat_list]
+
+
+class WatchPeerController(RotatingConsensus):
+	def __init__(self, *args, **kwargs):
+		# round id -> [signed_tx_hex, ...] for the transactions proposed that
+		# round (with pipelined rounds, round_done may still be using the
+		# previous one). Set before the consensus thread can start.
+		self.round_local_txs = {}
+		RotatingConsensus.__init__(self, *args, **kwargs)
+
+	def gen_master_msg(self):
+		if not check_reset_connections():
+			return None
+
+		# Work from a snapshot so the chain scanners can keep applying blocks while
+		# we talk to bitcoind; sign_withdraw_tx does the (short) locked commit
+		max_sidechain_height = sidechain.get().getblockcount() - 8
+		pending_snapshot = snapshot_pending_withdraws(max_sidechain_height)
+
+		# Withdraws we have never tried take priority, packed into as many
+		# transactions as needed; otherwise retry everything in one double-spend
+		untried = [output for output in pending_snapshot if len(output.spent_from) == 0]
+		if len(untried) != 0:
+			batches = [(batch, []) for batch in pack_withdraws([[output] for output in untried])]
+		else:
+			batches = select_retry_withdraws(pending_snapshot)
+			if len(batches) == 0:
+				return None
+
+		proposals = []
+		used_inputs = set()
+		locked_inputs = []
 		try:
-			self.round_local_tx_hex = sign_withdraw_tx(msg_decoded[0], msg_decoded[1])
-			return self.round_local_tx_hex
+			for (outputs, inputs_required) in batches:
+				try:
+					proposals.append(fund_and_sign_withdraw_tx(outputs, inputs_required, used_inputs, locked_inputs))
+				except Exception as e:
+					if len(proposals) == 0:
+						raise
+					# Whatever we already signed still has to go out
+					print("Failed to build withdraw transaction %d of %d, proposing the first %d: %s" % (len(proposals) + 1, len(batches), len(proposals), str(e)))
+					break
 		finally:
-			map_lock.release()
+			if len(locked_inputs) != 0:
+				bitcoin.get().lockunspent(True, locked_inputs)
 
-	def round_done(self, peer_messages):
-		txn_concat = self.round_local_tx_hex
-		check_raise(txn_concat != "")
+		self.round_local_txs[self.round_id] = [proposal[0] for proposal in proposals]
+		return json.dumps(proposals)
 
-		input_list = []
-		for inp in bitcoin[thread_id()].decoderawtransaction(txn_concat)["vin"]:
-			input_list.append((inp["txid"], inp["vout"]))
+	def recv_master_msg(self, msg):
+		proposals = json.loads(msg)
+		check_raise(len(proposals) <= settings.withdraw_txs_per_round)
+		local_txs = []
+		for (tx_hex, txid_concat_list) in proposals:
+			check_raise(len(tx_hex)/2 <= settings.withdraw_tx_max_size)
+			local_txs.append(sign_withdraw_tx(tx_hex, txid_concat_list))
+		self.round_local_txs[self.round_id] = local_txs
+		return json.dumps(local_txs)
 
+	def round_done(self, peer_messages):
+		# With pipelined rounds this runs on its own thread, whose connections
+		# nothing else checks
+		check_reset_connections()
+		local_txs = self.round_local_txs.pop(self.done_round_id, [])
+		# Anything older belongs to rounds which will never complete
+		for round_id in self.round_local_txs.keys():
+			if round_id < self.done_round_id:
+				self.round_local_txs.pop(round_id, None)
+		check_raise(len(local_txs) != 0)
+
+		peer_txs = []
 		for msg in peer_messages:
 			try:
-				for i, inp in enumerate(bitcoin[thread_id()].decoderawtransaction(msg[1])["vin"]):
-					check_raise(input_list[i] == (inp["txid"], inp["vout"]))
-				txn_concat = txn_concat + msg[1]
+				txs = json.loads(msg[1])
+				check_raise(len(txs) == len(local_txs))
+				peer_txs.append((msg[0], txs))
 			except:
-				print("Peer %s sent invalid transaction" % msg[0])
-
-		res = bitcoin[thread_id()].signrawtransaction(txn_concat)
-		print("Final round result:")
-		print(res)
+				print("Peer %s sent invalid response" % msg[0])
+
+		for n, txn_concat in enumerate(local_txs):
+			input_list = []
+			for inp in bitcoin.get().decoderawtransaction(txn_concat)["vin"]:
+				input_list.append((inp["txid"], inp["vout"]))
+
+			for (peer, txs) in peer_txs:
+				try:
+					for i, inp in enumerate(bitcoin.get().decoderawtransaction(txs[n])["vin"]):
+						check_raise(input_list[i] == (inp["txid"], inp["vout"]))
+					txn_concat = txn_concat + txs[n]
+				except:
+					print("Peer %s sent invalid transaction" % peer)
+
+			if settings.self_funded:
+				# Only combine, never touch the wallet's keystore
+				res = bitcoin.get().signrawtransaction(txn_concat, [], [])
+			else:
+				res = bitcoin.get().signrawtransaction(txn_concat)
+			print("Final round result:")
+			print(res)
 
-		if res["complete"]:
-			bitcoin[thread_id()].sendrawtransaction(res["hex"])
+			if res["complete"]:
+				bitcoin.get().sendrawtransaction(res["hex"])
 		return
 
 	def round_failed(self):
-		self.round_local_tx_hex = ""
+		self.round_local_txs.pop(self.round_id, None)
 		return
 
 
-def process_sidechain_tx_for_utxos(tx, height):
+# Sidechain blocks are handled in two steps: extract_* pulls everything we need
+# out of a block (doing any RPC and contracthashtool work) without touching our
+# state, so it can run in a worker process, then apply_* updates the maps.
+# Events are ("utxo", sidechain_txid, sidechain_vout, bitcoin_txid, bitcoin_vout, scriptPubKey_hex, value, redeem_script, private_key)
+#         or ("withdraw", txid_concat, p2sh_hash, value)
+
+# bitcoin txid -> decoded bitcoin tx, for the parents of withdrawout outputs
+# (bounded, oldest entries are dropped first)
+bitcoin_parent_txs = OrderedDict()
+BITCOIN_PARENT_TXS_MAX = 1000
+
+bitcoin_parent_txs_lock = Lock()
+
+def cache_bitcoin_parent_tx(txid, tx):
+	bitcoin_parent_txs_lock.acquire()
+	try:
+		bitcoin_parent_txs[txid] = tx
+		while len(bitcoin_parent_txs) > BITCOIN_PARENT_TXS_MAX:
+			bitcoin_parent_txs.popitem(last=False)
+	finally:
+		bitcoin_parent_txs_lock.release()
+
+def prefetch_bitcoin_parent_txs(txs):
+	# Fetch the bitcoin parents of every withdrawout output in txs in one batch
+	txids = []
+	for tx in txs:
+		for output in tx["vout"]:
+			if output["scriptPubKey"]["type"] == "withdrawout":
+				outp = output["scriptPubKey"]["asm"].split(" ")
+				if len(outp) == 16 and outp[2] not in bitcoin_parent_txs and outp[2] not in txids:
+					txids.append(outp[2])
+	if len(txids) == 0:
+		return
+	for txid, bitcoin_tx in zip(txids, bitcoin.get().batch_([["getrawtransaction", txid, 1] for txid in txids])):
+		cache_bitcoin_parent_tx(txid, bitcoin_tx)
+
+def get_bitcoin_parent_tx(txid):
+	# Scanner threads may evict entries at any time, so hold on to what we found
+	tx = bitcoin_parent_txs.get(txid)
+	if tx == None:
+		tx = bitcoin.get().getrawtransaction(txid, 1)
+		cache_bitcoin_parent_tx(txid, tx)
+	return tx
+
+# contract -> (modified_redeem_script, private_key), from contracthashtool
+# (bounded, oldest entries are dropped first)
+pegin_contracts = OrderedDict()
+pegin_contracts_lock = Lock()
+PEGIN_CONTRACTS_MAX = 1000
+
+def derive_pegin_contract(contract):
+	pegin_contracts_lock.acquire()
+	try:
+		derived = pegin_contracts.get(contract)
+	finally:
+		pegin_contracts_lock.release()
+	if derived != None:
+		metrics.inc("pegin_contracts.hits")
+		return derived
+	metrics.inc("pegin_contracts.misses")
+
+	modified_redeem_script = run_contracthashtool("-g -r %s -f %s" % (settings.redeem_script, contract))[2 + settings.is_testnet][24:]
+	gen_private_key = run_contracthashtool("-c -p %s -f %s" % (settings.functionary_private_key, contract))[0 + settings.is_testnet][16:]
+	derived = (modified_redeem_script, gen_private_key)
+
+	pegin_contracts_lock.acquire()
+	try:
+		pegin_contracts[contract] = derived
+		while len(pegin_contracts) > PEGIN_CONTRACTS_MAX:
+			pegin_contracts.popitem(last=False)
+	finally:
+		pegin_contracts_lock.release()
+	return derived
+
+# With settings.watch_sidechain_mempool, peg-in claims are looked at while they
+# are still in the sidechain mempool, filling the caches above (and importing
+# their scripts), so that handling them in a block is all cache hits
+
+def fetch_sidechain_mempool_txs(txids):
+	# Returns the decoded transactions, skipping any which have left the
+	# mempool (which fails the whole batch) since getrawmempool
+	try:
+		return sidechain.get().batch_([["getrawtransaction", txid, 1] for txid in txids])
+	except JSONRPCException:
+		txs = []
+		for txid in txids:
+			try:
+				txs.append(sidechain.get().getrawtransaction(txid, 1))
+			except JSONRPCException:
+				pass
+		return txs
+
+def precompute_pegin_claims(txs):
+	# Anything malformed is only logged: the block scan will reject it properly,
+	# and it must not stop us looking at the rest
+	try:
+		prefetch_bitcoin_parent_txs(txs)
+	except JSONRPCException as e:
+		print("Failed to prefetch bitcoin parents of sidechain mempool claims: %s" % str(e))
+	for tx in txs:
+		try:
+			for vout, output in enumerate(tx["vout"]):
+				if output["scriptPubKey"]["type"] == "withdrawout":
+					(modified_redeem_script, _) = derive_pegin_contract(tx["vin"][vout]["scriptSig"]["asm"].split(" ")[2])
+					import_bitcoin_script(modified_redeem_script)
+					metrics.inc("mempool_watch.claims")
+		except (CannotSendRequest, socket.timeout):
+			raise
+		except Exception as e:
+			print("Ignoring bad peg-in claim %s in sidechain mempool: %s" % (tx.get("txid"), str(e)))
+			metrics.inc("mempool_watch.bad_claims")
+
+MEMPOOL_POLL_INTERVAL = 2
+
+def watch_sidechain_mempool():
+	seen = set()
+	while True:
+		try:
+			mempool = sidechain.get().getrawmempool()
+			new_txids = [txid for txid in mempool if txid not in seen]
+			if len(new_txids) != 0:
+				precompute_pegin_claims(fetch_sidechain_mempool_txs(new_txids))
+			# Only forget about transactions once they leave the mempool (bad
+			# ones included, so they are not retried every poll). If we lost a
+			# connection above, everything new is retried.
+			seen = set(mempool)
+		except (CannotSendRequest, socket.timeout) as e:
+			sidechain.reset()
+			bitcoin.reset()
+		except Exception as e:
+			print("Sidechain mempool watch failed: %s" % str(e))
+		sleep(MEMPOOL_POLL_INTERVAL)
+
+def extract_sidechain_tx_for_utxos(tx):
+	events = []
 	for vout, output in enumerate(tx["vout"]):
 		if output["scriptPubKey"]["type"] == "withdrawout":
 			outp = output["scriptPubKey"]["asm"].split(" ")
 			check_raise(len(outp) == 16)
 
 			bitcoin_tx = outp[2]
-			bitcoin_raw_tx = bitcoin[thread_id()].getrawtransaction(bitcoin_tx, 1)
+			bitcoin_raw_tx = get_bitcoin_parent_tx(bitcoin_tx)
 			txo = bitcoin_raw_tx["vout"][int(outp[3])]
 
 			inp = tx["vin"][vout]["scriptSig"]["asm"].split(" ")
 			contract = inp[2]
 
-			cht = os.popen("%s %s -g -r %s -f %s" % (settings.contracthashtool_path, settings.cht_testnet_arg, settings.redeem_script, contract))
-			cht_out = cht.read()
-			check_raise(cht.close() == None)
-			modified_redeem_script = cht_out.split("\n")[2 + settings.is_testnet][24:]
-			modified_address = cht_out.split("\n")[3 + settings.is_testnet][40:]
-			bitcoin[thread_id()].importaddress(modified_redeem_script, "", False, True)
-
-			cht = os.popen("%s %s -c -p %s -f %s" % (settings.contracthashtool_path, settings.cht_testnet_arg, settings.functionary_private_key, contract))
-			gen_private_key = cht.read().split("\n")[0 + settings.is_testnet][16:]
-			check_raise(cht.close() == None)
+			(modified_redeem_script, gen_private_key) = derive_pegin_contract(contract)
 
-			outp[3] = int(outp[3])
+			events.append(("utxo", tx["txid"], vout, bitcoin_tx, int(outp[3]), txo["scriptPubKey"]["hex"], btc_to_satoshi(txo["value"]), modified_redeem_script, gen_private_key))
+	return events
 
-			map_lock.acquire()
-			already_had = (bitcoin_tx, outp[3]) in utxos
-			utxos[(bitcoin_tx, outp[3])] = {"redeem_info": {"txid": bitcoin_tx, "vout": outp[3], "scriptPubKey": txo["scriptPubKey"]["hex"], "redeemScript": modified_redeem_script}, "privateKey": gen_private_key, "value": decimal.Decimal(txo["value"]), "spent_by": set(), "donated_map": {}}
-			if already_had:
-				if height not in fraud_check_map:
-					fraud_check_map[height] = []
-				fraud_check_map[height].append((tx["txid"], vout))
-			map_lock.release()
-
-			print("Got %s UTXO (%s:%d) from sidechain tx %s:%d" % ("new" if not already_had else "existing", bitcoin_tx, outp[3], tx["txid"], vout))
-
-def process_sidechain_tx_for_withdraw(tx, height):
+def extract_sidechain_tx_for_withdraw(tx):
+	events = []
 	for vout, output in enumerate(tx["vout"]):
 		if output["scriptPubKey"]["type"] == "withdraw":
 			outp = output["scriptPubKey"]["asm"].split(" ")
@@ -407,221 +864,445 @@ def process_sidechain_tx_for_withdraw(tx, height):
 				contract = outp[0][8:]
 				check_raise(len(contract) == 40)
 
-				p2sh_script = "OP_HASH160 0x14%s OP_EQUAL" % outp[0][8:]
-				p2sh_hex = "a914%s87" % outp[0][8:]
-				txid_concat = tx["txid"] + ":" + str(vout)
-				value = decimal.Decimal(output["value"])
-				if txid_concat in spent_from_history:
-					output = {"txid_concat": txid_concat, "sidechain_height": height, "script_gen": p2sh_script, "script_match": p2sh_hex, "value": value, "spent_from": spent_from_history[txid_concat]}
-				else:
-					output = {"txid_concat": txid_concat, "sidechain_height": height, "script_gen": p2sh_script, "script_match": p2sh_hex, "value": value, "spent_from": set()}
-
-				# We track the set of inputs (from the utxos map) from which we've sent the withdraw,
-				# freely signing double-spends, but never allowing two non-conflicting withdraws
-				map_lock.acquire()
-				if txid_concat in outputs_pending:
-					print("Re-ran process_sidechain_tx_for_withdraw with existing withdraw: %s???" % txid_concat)
-					sys.exit(1)
-				if p2sh_hex in outputs_pending_by_p2sh_hex:
-					if p2sh_hex in outputs_waiting:
-						outputs_waiting[p2sh_hex].append(output)
-					else:
-						outputs_waiting[p2sh_hex] = [output]
-
-					print("Got new txo for withdraw (waiting on previous tx %s): %s" % (txid_concat, outputs_pending_by_p2sh_hex[p2sh_hex]))
-					map_lock.release()
-					continue
+				events.append(("withdraw", tx["txid"] + ":" + str(vout), contract, btc_to_satoshi(output["value"])))
+	return events
+
+def extract_sidechain_block(height):
+	# Returns (height, events, donated_value) for the block at height
+	events = []
+	donated = 0
+	block = sidechain.get().getblock(sidechain.get().getblockhash(height))
+	txs = sidechain.get().batch_([["getrawtransaction", txhash, 1] for txhash in block["tx"]])
+	prefetch_bitcoin_parent_txs(txs)
+	for tx in txs:
+		events.extend(extract_sidechain_tx_for_utxos(tx))
+		events.extend(extract_sidechain_tx_for_withdraw(tx))
+		for outp in tx["vout"]:
+			if outp["scriptPubKey"]["type"] == "nulldata":
+				donated = donated + btc_to_satoshi(outp["value"])
+	return (height, events, donated)
+
+def extract_sidechain_block_donations(height):
+	# Only needed for blocks process_sidechain_blockchain never saw
+	donated = 0
+	block = sidechain.get().getblock(sidechain.get().getblockhash(height))
+	for tx in sidechain.get().batch_([["getrawtransaction", txhash, 1] for txhash in block["tx"]]):
+		for outp in tx["vout"]:
+			if outp["scriptPubKey"]["type"] == "nulldata":
+				donated = donated + btc_to_satoshi(outp["value"])
+	return (height, [], donated)
+
+def apply_sidechain_utxo_event(event, height):
+	(_, sidechain_txid, vout, bitcoin_tx, bitcoin_vout, script_pubkey, value, modified_redeem_script, gen_private_key) = event
+	import_bitcoin_script(modified_redeem_script)
+
+	txid_pair = (txid_to_bin(bitcoin_tx), bitcoin_vout)
+
+	map_lock.acquire()
+	already_had = txid_pair in utxos
+	utxos[txid_pair] = Utxo(txid_pair[0], bitcoin_vout, script_pubkey, modified_redeem_script, gen_private_key, value)
+	if already_had:
+		if height not in fraud_check_map:
+			fraud_check_map[height] = []
+		fraud_check_map[height].append((sidechain_txid, vout))
+	map_lock.release()
+
+	print("Got %s UTXO (%s:%d) from sidechain tx %s:%d" % ("new" if not already_had else "existing", bitcoin_tx, bitcoin_vout, sidechain_txid, vout))
+
+def apply_sidechain_withdraw_event(event, height):
+	(_, txid_concat, contract, value) = event
+	if txid_concat in spent_from_history:
+		output = PendingWithdraw(txid_concat, height, contract, value, spent_from_history[txid_concat])
+	else:
+		output = PendingWithdraw(txid_concat, height, contract, value, set())
+	p2sh_hex = output.script_match
+
+	# We track the set of inputs (from the utxos map) from which we've sent the withdraw,
+	# freely signing double-spends, but never allowing two non-conflicting withdraws
+	map_lock.acquire()
+	if txid_concat in outputs_pending:
+		print("Re-ran process_sidechain_tx_for_withdraw with existing withdraw: %s???" % txid_concat)
+		sys.exit(1)
+	if p2sh_hex in outputs_pending_by_p2sh_hex:
+		if p2sh_hex in outputs_waiting:
+			outputs_waiting[p2sh_hex].append(output)
+		else:
+			outputs_waiting[p2sh_hex] = deque([output])
+
+		print("Got new txo for withdraw (waiting on previous tx %s): %s" % (txid_concat, outputs_pending_by_p2sh_hex[p2sh_hex]))
+		map_lock.release()
+		return
 
-				outputs_pending[txid_concat] = output
-				outputs_pending_by_p2sh_hex[p2sh_hex] = txid_concat
-				print("Got new txo for withdraw: %s (to %s with value %s)" % (txid_concat, p2sh_hex, str(value)))
-				map_lock.release()
+	outputs_pending[txid_concat] = output
+	outputs_pending_by_p2sh_hex[p2sh_hex] = txid_concat
+	print("Got new txo for withdraw: %s (to %s with value %s)" % (txid_concat, p2sh_hex, satoshi_to_btc(value)))
+	map_lock.release()
+
+def apply_sidechain_events(events, height):
+	for event in events:
+		if event[0] == "utxo":
+			apply_sidechain_utxo_event(event, height)
+		else:
+			apply_sidechain_withdraw_event(event, height)
+
+def start_scanner_pool():
+	global scanner_pool
+	if settings.scanner_threads > 1:
+		scanner_pool = ScannerPool(settings.scanner_threads)
+
+def extract_blocks(extract, min_height, max_height):
+	# Yields extract(height) for every height in [min_height, max_height), in
+	# order, using scanner_pool if there is one
+	if scanner_pool == None or max_height - min_height <= 1:
+		for height in xrange(min_height, max_height):
+			yield extract(height)
+		return
+	for result in scanner_pool.imap(extract, xrange(min_height, max_height)):
+		yield result
 
 def process_sidechain_blockchain(min_height, max_height):
-	for height in range(min_height, max_height):
-		block = sidechain[thread_id()].getblock(sidechain[thread_id()].getblockhash(height))
-		for tx in sidechain[thread_id()].batch_([["getrawtransaction", txhash, 1] for txhash in block["tx"]]):
-			process_sidechain_tx_for_utxos(tx, height)
-			process_sidechain_tx_for_withdraw(tx, height)
+	for (height, events, donated) in extract_blocks(extract_sidechain_block, min_height, max_height):
+		apply_sidechain_events(events, height)
+		pending_donations[height] = donated
+		metrics.inc("blocks.sidechain")
+		metrics.set_gauge("scan_lag.sidechain", max_height - 1 - height)
 
-def process_confirmed_sidechain_blockchain(min_height, max_height):
+def credit_sidechain_donations(donated):
 	global donated_funds
 
-	for height in range(min_height, max_height):
+	if donated != 0:
 		map_lock.acquire()
-		fraud_check_list = None
-		if height in fraud_check_map:
-			fraud_check_list = fraud_check_map[height]
-			del fraud_check_map[height]
+		donated_funds += donated
 		map_lock.release()
-		if fraud_check_list != None:
-			for txo in fraud_check_list:
-				if sidechain[thread_id()].gettxout(txo[0], txo[1], False) != None:
-					print("NO FRAUD PROOF GENERATED WITHIN CONFIRMATION PERIOD FOR TXO %s" % str(txo))
-					sys.exit(1)
 
-		block = sidechain[thread_id()].getblock(sidechain[thread_id()].getblockhash(height))
-		for tx in sidechain[thread_id()].batch_([["getrawtransaction", txhash, 1] for txhash in block["tx"]]):
-			for outp in tx["vout"]:
-				if outp["scriptPubKey"]["type"] == "nulldata":
-					map_lock.acquire()
-					donated_funds += outp["value"]
-					map_lock.release()
+def run_sidechain_fraud_checks(min_height, max_height):
+	# Every txo which came due in [min_height, max_height) is checked with a
+	# single batched gettxout call
+	map_lock.acquire()
+	fraud_check_list = []
+	fraud_check_seen = set()
+	for height in sorted([h for h in fraud_check_map if h >= min_height and h < max_height]):
+		for txo in fraud_check_map[height]:
+			if txo not in fraud_check_seen:
+				fraud_check_seen.add(txo)
+				fraud_check_list.append(txo)
+		del fraud_check_map[height]
+	map_lock.release()
+	if len(fraud_check_list) == 0:
+		return
 
+	results = sidechain.get().batch_([["gettxout", txo[0], txo[1], False] for txo in fraud_check_list])
+	for txo, txout in zip(fraud_check_list, results):
+		if txout != None:
+			print("NO FRAUD PROOF GENERATED WITHIN CONFIRMATION PERIOD FOR TXO %s" % str(txo))
+			sys.exit(1)
 
-def process_confirmed_bitcoin_blockchain(min_height, max_height):
-	global donated_funds
+def process_confirmed_sidechain_blockchain(min_height, max_height):
+	# Everything here was extracted when process_sidechain_blockchain first saw
+	# the block; we only act on it once the block is deep enough
+	run_sidechain_fraud_checks(min_height, max_height)
 
 	for height in range(min_height, max_height):
-		block = bitcoin[thread_id()].getblock(bitcoin[thread_id()].getblockhash(height))
-		for tx in bitcoin[thread_id()].batch_([["getrawtransaction", txhash, 1] for txhash in block["tx"]]):
-			map_lock.acquire()
-			is_withdraw = False
-			is_not_withdraw = False
-			tx_value = 0
-
-			# First process the inputs, checking if its a withdraw transaction (ie spends from utxos)
-			# then remove that utxo, including from ensure-double-spend-sets in outputs_pending
-			for inp in tx["vin"]:
-				if "coinbase" in inp:
-					continue
+		if height in pending_donations:
+			donated = pending_donations.pop(height)
+		else:
+			(_, _, donated) = extract_sidechain_block_donations(height)
+		credit_sidechain_donations(donated)
+		metrics.inc("blocks.sidechain_confirmed")
+		metrics.set_gauge("scan_lag.sidechain_confirmed", max_height - 1 - height)
+
+
+def process_confirmed_bitcoin_tx(tx):
+	global donated_funds, withdraw_state_version
+
+	map_lock.acquire()
+	is_withdraw = False
+	is_not_withdraw = False
+	tx_value = 0
+
+	# First process the inputs, checking if its a withdraw transaction (ie spends from utxos)
+	# then remove that utxo, including from ensure-double-spend-sets in outputs_pending
+	for inp in tx["vin"]:
+		if "coinbase" in inp:
+			continue
 
-				txid_pair = (inp["txid"], inp["vout"])
-				if txid_pair not in utxos:
-					if is_withdraw:
-						print("Got transaction that spent both functionary utxos and non-functionary utxos...very confused")
-						sys.exit(1)
-					is_not_withdraw = True
-				else:
-					if is_not_withdraw:
-						print("Got transaction that spent both functionary utxos and non-functionary utxos...very confused")
-						sys.exit(1)
-					is_withdraw = True
-
-					utxo = utxos[txid_pair]
-
-					for txid_concat in utxo["spent_by"]:
-						if txid_concat in outputs_pending:
-							new_spent_from = set()
-							output = outputs_pending[txid_concat]
-							for inputs_set in output["spent_from"]:
-								if txid_pair not in inputs_set:
-									new_spent_from.add(inputs_set)
-							output["spent_from"] = new_spent_from
-
-					# Calculate donated_funds by re-adding all temporary removals that this invalidated
-					total_donated_value = 0
-					for txid_set in utxo["donated_map"]:
-						donated_value = utxo["donated_map"][txid_set]
-						for txid_pair_it in txid_set:
-							if txid_pair_it == txid_pair:
-								continue
-
-							if utxos[txid_pair_it]["donated_map"][txid_set] != donated_value:
-								print("Internal data structure inconsistency")
-								sys.exit(1)
-							del utxos[txid_pair_it]["donated_map"][txid_set]
-
-						total_donated_value = total_donated_value + donated_value
-					donated_funds = donated_funds + total_donated_value
-
-					tx_value = tx_value + utxo["value"]
-					del utxos[txid_pair]
-
-			# Then go through outputs, removing them from outputs_pending and warning if
-			# we dont know where the money went
+		txid_pair = (txid_to_bin(inp["txid"]), inp["vout"])
+		if txid_pair not in utxos:
 			if is_withdraw:
-				for outp in tx["vout"]:
-					script_asm = outp["scriptPubKey"]["hex"]
-					if script_asm in outputs_pending_by_p2sh_hex:
-						sys.stdout.write("Successfully completed withdraw for sidechain tx %s in bitcoin tx %s:%d" % (outputs_pending_by_p2sh_hex[script_asm], tx["txid"], outp["n"]))
-
-						del outputs_pending[outputs_pending_by_p2sh_hex[script_asm]]
-						del outputs_pending_by_p2sh_hex[script_asm]
-
-						if script_asm in outputs_waiting:
-							output = outputs_waiting[script_asm].pop(0)
-							outputs_pending[output["txid_concat"]] = output
-							outputs_pending_by_p2sh_hex[script_asm] = output["txid_concat"]
-							if len(outputs_waiting[script_asm]) == 0:
-								del outputs_waiting[script_asm]
-							sys.stdout.write("...next output to same address is %s" % output["txid_concat"])
-
-						sys.stdout.write("\n")
-						sys.stdout.flush()
-
-					elif outp["scriptPubKey"]["type"] != "scripthash" or outp["scriptPubKey"]["addresses"][0] != settings.redeem_script_address:
-						print("MONEY MOVED FROM FUNCTIONARY OUTPUT TO UNKNOWN DESTINATION!!!!")
-						print("In transaction %s in output %d" % (tx["txid"], outp["n"]))
-						sys.exit(1)
-
-					tx_value = tx_value - outp["value"]
-
-				# Remove fee from donated_funds
-				if tx_value > 0:
-					donated_funds = donated_funds - tx_value
-
-			map_lock.release()
-
-			# Finally, without map_lock held (we'll grab it again if needed in process_bitcoin_tx_for_utxos),
-			# we add any outputs which are to the functionary address to the utxos set.
-			process_bitcoin_tx_for_utxos(tx, not is_withdraw)
+				print("Got transaction that spent both functionary utxos and non-functionary utxos...very confused")
+				sys.exit(1)
+			is_not_withdraw = True
+		else:
+			if is_not_withdraw:
+				print("Got transaction that spent both functionary utxos and non-functionary utxos...very confused")
+				sys.exit(1)
+			is_withdraw = True
 
-try:
-	print("Doing chain-scan init...")
+			utxo = utxos[txid_pair]
 
-	print("Step 1. Sidechain blockchain scan for coins in and withdraws...")
-	# First do a pass over all existing blocks to collect all utxos
-	sidechain_block_count = sidechain[thread_id()].getblockcount()
-	process_sidechain_blockchain(1, sidechain_block_count)
-	process_confirmed_sidechain_blockchain(1, sidechain_block_count - 5)
-	print("done")
+			for txid_concat in utxo.spent_by:
+				if txid_concat in outputs_pending:
+					new_spent_from = set()
+					output = outputs_pending[txid_concat]
+					for inputs_set in output.spent_from:
+						if txid_pair not in inputs_set:
+							new_spent_from.add(inputs_set)
+					output.spent_from = new_spent_from
+
+			# Calculate donated_funds by re-adding all temporary removals that this invalidated
+			total_donated_value = 0
+			for txid_set in (utxo.donated_map or {}):
+				donated_value = utxo.donated_map[txid_set]
+				for txid_pair_it in txid_set:
+					if txid_pair_it == txid_pair:
+						continue
+
+					if utxos[txid_pair_it].donated_map[txid_set] != donated_value:
+						print("Internal data structure inconsistency")
+						sys.exit(1)
+					del utxos[txid_pair_it].donated_map[txid_set]
+
+				total_donated_value = total_donated_value + donated_value
+			donated_funds = donated_funds + total_donated_value
+
+			tx_value = tx_value + utxo.value
+			del utxos[txid_pair]
+
+	# Then go through outputs, removing them from outputs_pending and warning if
+	# we dont know where the money went
+	if is_withdraw:
+		withdraw_state_version += 1
+		for outp in tx["vout"]:
+			script_asm = outp["scriptPubKey"]["hex"]
+			if script_asm in outputs_pending_by_p2sh_hex:
+				sys.stdout.write("Successfully completed withdraw for sidechain tx %s in bitcoin tx %s:%d" % (outputs_pending_by_p2sh_hex[script_asm], tx["txid"], outp["n"]))
+
+				del outputs_pending[outputs_pending_by_p2sh_hex[script_asm]]
+				del outputs_pending_by_p2sh_hex[script_asm]
+
+				if script_asm in outputs_waiting:
+					output = outputs_waiting[script_asm].popleft()
+					outputs_pending[output.txid_concat] = output
+					outputs_pending_by_p2sh_hex[script_asm] = output.txid_concat
+					if len(outputs_waiting[script_asm]) == 0:
+						del outputs_waiting[script_asm]
+					sys.stdout.write("...next output to same address is %s" % output.txid_concat)
+
+				sys.stdout.write("\n")
+				sys.stdout.flush()
+
+			elif outp["scriptPubKey"]["type"] != "scripthash" or outp["scriptPubKey"]["addresses"][0] != settings.redeem_script_address:
+				print("MONEY MOVED FROM FUNCTIONARY OUTPUT TO UNKNOWN DESTINATION!!!!")
+				print("In transaction %s in output %d" % (tx["txid"], outp["n"]))
+				sys.exit(1)
 
-	print("Step 2. Bitcoin blockchain scan for withdraws completed and coins to functionaries...")
-	bitcoin_block_count = bitcoin[thread_id()].getblockcount()
-	process_confirmed_bitcoin_blockchain(447000, bitcoin_block_count - 5)
-	print("done")
+			tx_value = tx_value - btc_to_satoshi(outp["value"])
+
+		# Remove fee from donated_funds
+		if tx_value > 0:
+			donated_funds = donated_funds - tx_value
+
+	map_lock.release()
+
+	# Finally, without map_lock held (we'll grab it again if needed in process_bitcoin_tx_for_utxos),
+	# we add any outputs which are to the functionary address to the utxos set.
+	process_bitcoin_tx_for_utxos(tx, not is_withdraw)
+
+def decode_bitcoin_block_txs(height, tx_filter):
+	# Fetches the block at height in serialized form and only fully decodes the
+	# transactions which pass tx_filter (or spend from one which did), so scan
+	# cost follows functionary activity instead of total chain volume
+	block = bitcoin.get().getblock(bitcoin.get().getblockhash(height), False)
+	candidates = []
+	candidate_txids = set()
+	for tx in parse_block(block.decode("hex")):
+		if tx_filter(tx) or any([inp[0] in candidate_txids for inp in tx.inputs]):
+			candidates.append(tx.data.encode("hex"))
+			candidate_txids.add(tx.txid)
+	if len(candidates) == 0:
+		return []
+	return bitcoin.get().batch_([["decoderawtransaction", tx_hex] for tx_hex in candidates])
+
+def spends_or_pays_tracked_outputs(tx):
+	if functionary_p2sh_script in tx.output_scripts:
+		return True
+	for inp in tx.inputs:
+		if (inp[0], inp[1]) in utxos:
+			return True
+	return False
+
+def reveals_functionary_redeem_script(script_sig):
+	# Spending any functionary output (to the raw or a contract-modified redeem
+	# script) reveals a redeemScript with the same shape as settings.redeem_script
+	script_len = len(functionary_redeem_script)
+	return len(script_sig) >= script_len and script_sig[-script_len:-script_len + 2] == functionary_redeem_script[:2] and script_sig.endswith(functionary_redeem_script[-2:])
+
+def may_spend_or_pay_functionaries(tx):
+	# Like spends_or_pays_tracked_outputs, but without needing to know utxos
+	if functionary_p2sh_script in tx.output_scripts:
+		return True
+	for inp in tx.inputs:
+		if reveals_functionary_redeem_script(inp[2]):
+			return True
+	return False
 
-	sys.stdout.write("Step 3. Bitcoin blockchain rescan to load functionary outputs in wallet...")
-	sys.stdout.flush()
-	bitcoin[thread_id()].importaddress(settings.redeem_script, "", False, True)
-	trigger_bitcoin_rescan()
-	print("done")
+def process_confirmed_bitcoin_blockchain(min_height, max_height):
+	if scanner_pool == None:
+		# Blocks are decoded one at a time, after the previous one was applied,
+		# so we can filter on exactly the outputs we track
+		blocks = ((height, decode_bitcoin_block_txs(height, spends_or_pays_tracked_outputs)) for height in xrange(min_height, max_height))
+	else:
+		blocks = extract_blocks(extract_bitcoin_block, min_height, max_height)
+	for (height, txs) in blocks:
+		for tx in txs:
+			process_confirmed_bitcoin_tx(tx)
+		metrics.inc("blocks.bitcoin")
+		metrics.set_gauge("scan_lag.bitcoin", max_height - 1 - height)
+
+def extract_bitcoin_block(height):
+	# Returns (height, txs) where txs is every transaction in the block at height
+	# which process_confirmed_bitcoin_tx could possibly act on, without needing
+	# to know the current utxos
+	return (height, decode_bitcoin_block_txs(height, may_spend_or_pay_functionaries))
+
+def init_scan_worker():
+	# Worker processes must not share the parent's RPC sockets
+	sidechain.discard_all()
+	bitcoin.discard_all()
+
+def start_sync_pool():
+	global sync_pool
+	if settings.initial_sync_processes > 1:
+		sync_pool = multiprocessing.Pool(settings.initial_sync_processes, init_scan_worker)
+
+def stop_sync_pool():
+	global sync_pool
+	if sync_pool != None:
+		sync_pool.terminate()
+		sync_pool = None
+
+def extract_in_worker(job):
+	# Runs extract(height) in a worker process. Anything raised has to be
+	# unpickled by the parent, which python-bitcoinrpc's JSONRPCException
+	# cannot be (and a failed unpickle leaves imap waiting forever), so errors
+	# go back as plain Exceptions.
+	(extract, height) = job
+	try:
+		return extract(height)
+	except JSONRPCException as e:
+		raise Exception("RPC error extracting block %d: %s" % (height, repr(e.error)))
+	except Exception as e:
+		raise Exception("Failed extracting block %d: %s" % (height, traceback.format_exc()))
+
+def extract_in_workers(extract, min_height, max_height):
+	# Yields extract(height) for every height in [min_height, max_height), in
+	# order, computed by sync_pool's worker processes
+	for result in sync_pool.imap(extract_in_worker, ((extract, height) for height in xrange(min_height, max_height)), 16):
+		yield result
+
+# The initial sync may split the height range across worker processes, which
+# only extract per-block events. We apply them here in height order, so the end
+# result is exactly that of the serial scan.
+
+def initial_sidechain_sync(max_height):
+	if sync_pool == None:
+		process_sidechain_blockchain(1, max_height)
+		process_confirmed_sidechain_blockchain(1, max_height - 5)
+		return
 
-	print("Init done. Joining rotating consensus and watching chain for withdraws...")
-	#TODO: Change interval to ~60
-	settings.nodes.remove(settings.my_node)
-	WatchPeerController(settings.nodes, settings.my_node, port, 10, settings.socks_proxy)
+	for (height, events, donated) in extract_in_workers(extract_sidechain_block, 1, max_height):
+		apply_sidechain_events(events, height)
+		pending_donations[height] = donated
+		metrics.inc("blocks.sidechain")
+		metrics.set_gauge("scan_lag.sidechain", max_height - 1 - height)
+	process_confirmed_sidechain_blockchain(1, max_height - 5)
 
-	print("Outputs to be created:")
-	for txid_concat in outputs_pending:
-		sys.stdout.write(" " + txid_concat)
-	print("\nOutputs waiting:")
-	for p2sh_hex in outputs_waiting:
-		for output in outputs_waiting[p2sh_hex]:
-			sys.stdout.write(" " + output["txid_concat"])
-	print("")
+def initial_bitcoin_sync(min_height, max_height):
+	if sync_pool == None:
+		process_confirmed_bitcoin_blockchain(min_height, max_height)
+		return
 
-	while True:
-		if not check_reset_connections():
-			sleep(1)
-			continue
+	for (height, txs) in extract_in_workers(extract_bitcoin_block, min_height, max_height):
+		for tx in txs:
+			process_confirmed_bitcoin_tx(tx)
+		metrics.inc("blocks.bitcoin")
+		metrics.set_gauge("scan_lag.bitcoin", max_height - 1 - height)
+
+metrics.gauge_callback("withdraws.pending", lambda: len(outputs_pending))
+metrics.gauge_callback("withdraws.waiting", lambda: sum([len(x) for x in outputs_waiting.values()]))
+metrics.gauge_callback("fraud_checks", lambda: sum([len(x) for x in fraud_check_map.values()]))
+metrics.gauge_callback("utxos", lambda: len(utxos))
+metrics.gauge_callback("donated_funds", lambda: satoshi_to_btc(donated_funds))
+def main():
+	# The sync workers are forked first, while this is still the only thread
+	start_sync_pool()
+	start_scanner_pool()
+	start_exporter(settings.withdrawwatch_metrics_port)
 
-		new_block_count = sidechain[thread_id()].getblockcount()
-		process_sidechain_blockchain(sidechain_block_count, new_block_count)
-		process_confirmed_sidechain_blockchain(sidechain_block_count - 5, new_block_count - 5)
-		sidechain_block_count = new_block_count
+	try:
+		print("Doing chain-scan init...")
+
+		print("Step 1. Sidechain blockchain scan for coins in and withdraws...")
+		# First do a pass over all existing blocks to collect all utxos
+		sidechain_block_count = sidechain.get().getblockcount()
+		initial_sidechain_sync(sidechain_block_count)
+		print("done")
+
+		print("Step 2. Bitcoin blockchain scan for withdraws completed and coins to functionaries...")
+		bitcoin_block_count = bitcoin.get().getblockcount()
+		initial_bitcoin_sync(447000, bitcoin_block_count - 5)
+		stop_sync_pool()
+		print("done")
+
+		if not settings.self_funded:
+			sys.stdout.write("Step 3. Bitcoin blockchain rescan to load functionary outputs in wallet...")
+			sys.stdout.flush()
+			import_bitcoin_script(settings.redeem_script)
+			rescan_imported_scripts()
+			print("done")
+
+		if settings.watch_sidechain_mempool:
+			thread = Thread(target=watch_sidechain_mempool, name="mempool-watch")
+			thread.daemon = True
+			thread.start()
+
+		print("Init done. Joining rotating consensus and watching chain for withdraws...")
+		#TODO: Change interval to ~60
+		settings.nodes.remove(settings.my_node)
+		WatchPeerController(settings.nodes, settings.my_node, port, 10, settings.socks_proxy, quorum=settings.consensus_quorum, compress=settings.consensus_compress, trace_file=settings.consensus_trace_file, liveness_slots=settings.consensus_liveness_slots, clock_sync=settings.consensus_clock_sync, pipeline=settings.consensus_pipeline)
+
+		print("Outputs to be created:")
+		for txid_concat in outputs_pending:
+			sys.stdout.write(" " + txid_concat)
+		print("\nOutputs waiting:")
+		for p2sh_hex in outputs_waiting:
+			for output in outputs_waiting[p2sh_hex]:
+				sys.stdout.write(" " + output.txid_concat)
+		print("")
+
+		while True:
+			if not check_reset_connections():
+				sleep(1)
+				continue
+
+			new_block_count = sidechain.get().getblockcount()
+			process_sidechain_blockchain(sidechain_block_count, new_block_count)
+			process_confirmed_sidechain_blockchain(sidechain_block_count - 5, new_block_count - 5)
+			sidechain_block_count = new_block_count
+
+			if not check_reset_connections():
+				sleep(1)
+				continue
+
+			new_block_count = bitcoin.get().getblockcount()
+			process_confirmed_bitcoin_blockchain(bitcoin_block_count - 5, new_block_count - 5)
+			bitcoin_block_count = new_block_count
 
-		if not check_reset_connections():
 			sleep(1)
-			continue
-
-		new_block_count = bitcoin[thread_id()].getblockcount()
-		process_confirmed_bitcoin_blockchain(bitcoin_block_count - 5, new_block_count - 5)
-		bitcoin_block_count = new_block_count
 
-		sleep(1)
+	except JSONRPCException as e:
+		print(e.error)
+		print(traceback.format_exc())
 
-except JSONRPCException as e:
-	print(e.error)
-	print(traceback.format_exc())
+if __name__ == "__main__":
+	main()
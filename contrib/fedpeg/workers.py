@@ -0,0 +1,95 @@
+#!/usr/bin/env python2
+
+# Execution model for the fedpeg daemons: every thread (the main chain-scan
+# loop, the rotating consensus thread and any scanner threads) talks to
+# bitcoind/sidechaind over its own RPC connections, handed out by a
+# ConnectionRegistry, as AuthServiceProxy connections must never be shared.
+
+import threading, Queue
+from collections import deque
+from metrics import metrics
+
+class ConnectionRegistry:
+	# Lazily creates one connection per thread with factory()
+	def __init__(self, factory, name):
+		self.factory = factory
+		self.name = name
+		self.local = threading.local()
+		self.lock = threading.Lock()
+		self.created = 0
+		metrics.gauge_callback("rpc.%s.connections" % name, lambda: self.created)
+
+	def get(self):
+		connection = getattr(self.local, "connection", None)
+		if connection == None:
+			connection = self.reset()
+		return connection
+
+	def reset(self):
+		# Replace the calling thread's connection (eg after a timeout)
+		connection = self.factory()
+		self.local.connection = connection
+		self.lock.acquire()
+		self.created += 1
+		self.lock.release()
+		return connection
+
+	def discard_all(self):
+		# Forget every thread's connection, for use in a freshly-forked process
+		# which must not share its parent's sockets
+		self.local = threading.local()
+
+
+class ScanJob:
+	def __init__(self, func, arg):
+		self.func = func
+		self.arg = arg
+		self.done = threading.Event()
+		self.result = None
+		self.error = None
+
+	def run(self):
+		try:
+			self.result = self.func(self.arg)
+		except Exception as e:
+			self.error = e
+		self.done.set()
+
+
+class ScannerPool:
+	# A fixed set of daemon threads which run chain-scan extract functions.
+	# Each thread picks up its own connections from the registries on first use.
+	def __init__(self, thread_count, name="scanner"):
+		self.jobs = Queue.Queue()
+		self.threads = []
+		for i in range(thread_count):
+			thread = threading.Thread(target=self.worker_loop, name="%s-%d" % (name, i))
+			thread.daemon = True
+			thread.start()
+			self.threads.append(thread)
+
+	def worker_loop(self):
+		while True:
+			self.jobs.get().run()
+
+	def imap(self, func, args, window=None):
+		# Yields func(arg) for every arg, in order, keeping at most window
+		# (default: twice the thread count) calls in flight. Exceptions are
+		# re-raised here, in the caller's thread.
+		if window == None:
+			window = 2 * len(self.threads)
+		in_flight = deque()
+		for arg in args:
+			job = ScanJob(func, arg)
+			self.jobs.put(job)
+			in_flight.append(job)
+			if len(in_flight) >= window:
+				yield self.wait(in_flight.popleft())
+		while len(in_flight) != 0:
+			yield self.wait(in_flight.popleft())
+
+	def wait(self, job):
+		job.done.wait()
+		if job.error != None:
+			raise job.error
+		return job.result